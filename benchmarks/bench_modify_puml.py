@@ -0,0 +1,85 @@
+"""Micro-benchmark for crawler.modify_puml: lines per second over large synthetic PlantUML files
+
+Usage:
+    python bench_modify_puml.py [--files N] [--classes N] [--repeat N] [--crawler DIR]
+
+Use --crawler to point at another src directory (e.g. a git worktree of an older commit)
+to measure that version of crawler.py, for a before/after comparison.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_puml(name: str, classes: int) -> str:
+    """Return a Resource PUML file shaped like the TMF generated ones, with about 10 lines per class"""
+    lines = ['@startuml', 'hide circle', 'hide methods', 'hide stereotype', 'show <<Enumeration>> stereotype',
+             'skinparam class {', '   BackgroundColor<<Enumeration>> #E6F5F7', '}', '',
+             f'class {name} <<Pivot>> {{', '    id : String', '    href : String', '}', '']
+    for i in range(classes):
+        kind = i % 4
+        if kind == 0:
+            lines.append(f'class {name}Part{i}Ref <<Ref>> {{')
+        elif kind == 1:
+            lines.append(f'class Related{name}Part{i}RefOrValue {{')
+        elif kind == 2:
+            lines.append(f'class {name}Part{i}RefOrValue {{')
+        else:
+            lines.append(f'class {name}Part{i} {{')
+        lines += [f'    attribute{j} : String' for j in range(6)] + ['}', '']
+        lines.append(f'{name} *-->  "0..*" {name}Part{i} : part{i}')
+    lines.append('@enduml')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=50, help='Number of PUML files (default: 50)')
+    parser.add_argument('--classes', type=int, default=2000, help='Classes per PUML file (default: 2000)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed passes over the files; the best is reported (default: 3)')
+    parser.add_argument('--crawler', default=os.path.join(HERE, '..', 'src'), help='Directory holding the crawler.py to measure')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.crawler))
+    import crawler
+    # Older versions of modify_puml check that the PlantUML JAR exists - any file will do
+    crawler.PLANT_JAR = os.path.abspath(__file__)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        in_dir = os.path.join(tmp, 'in')
+        out_dir = os.path.join(tmp, 'out')
+        os.mkdir(in_dir)
+        os.mkdir(out_dir)
+
+        db = {'api': {'620': {'id': '620', 'name': 'Bench', 'version': '4.0.0', 'notifications': ['CreateEvent', 'DeleteEvent']}},
+              'schema': {}}
+        files = []
+        lines = 0
+        for i in range(args.files):
+            name = f'Bench{i}'
+            db['schema'][name] = {'name': name, 'domain': 'Bench', 'api': '620', 'description': f'The {name} resource ' * 10}
+            puml = make_puml(name, args.classes)
+            lines += puml.count('\n')
+            path = os.path.join(in_dir, f'Resource_{name}.puml')
+            with open(path, 'w') as f:
+                f.write(puml)
+            files.append(path)
+
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for path in files:
+                crawler.modify_puml(path, out_dir, db)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+    print(f'modify_puml [{os.path.abspath(crawler.__file__)}]: {lines} lines in {args.files} files, '
+          f'best of {args.repeat}: {best:.3f}s = {lines / best:,.0f} lines/sec')
+
+
+if __name__ == '__main__':
+    main()
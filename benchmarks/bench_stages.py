@@ -0,0 +1,121 @@
+"""Benchmark each stage of the crawler over synthetic TMF-shaped repositories (see make_corpus.py) of several sizes
+
+Usage:
+    python bench_stages.py [--sizes 100 1000 10000] [--workers N] [--seconds-per-class S] [--no-memory] [--verbose] [--output FILE]
+
+Reports the time, throughput (files/sec) and peak traced Python memory of each stage at each size, and writes
+them to --output as JSON. PlantUML is replaced by stub_plantuml.py, so generate_diagrams measures the
+batching and scheduling overhead (plus --seconds-per-class of simulated rendering), not Java.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUB = os.path.join(HERE, 'stub_plantuml.py')
+
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+from make_corpus import make_corpus
+
+
+def run_stage(results: dict, name: str, count: int, verbose: bool, function, *args, **kwargs):
+    """Run {function}(*args, **kwargs) as the {name} stage over {count} files, recording its figures into {results}.
+    The crawler's progress messages are dropped, unless {verbose}"""
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        value = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    stage = {'files': count, 'seconds': seconds, 'files_per_second': count / seconds if seconds else None}
+    if tracemalloc.is_tracing():
+        stage['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+    results[name] = stage
+    print(f'bench_stages: {name:<20} {count:>6} files {seconds:>8.2f}s {stage["files_per_second"] or 0:>10,.0f} files/sec'
+          + (f' {stage["peak_traced_bytes"] / 1024**2:>8.1f} MB' if 'peak_traced_bytes' in stage else ''))
+    return value
+
+
+def bench(crawler, root: str, out_dir: str, workers: int, verbose: bool) -> dict:
+    """Run each crawler stage in turn over the repository at {root}, writing outputs under {out_dir}"""
+    results = {}
+    puml_dir = os.path.join(out_dir, 'puml')
+    svg_dir = os.path.join(out_dir, 'svg')
+    os.makedirs(puml_dir)
+    os.makedirs(svg_dir)
+
+    def stage(name, count, function, *args, **kwargs):
+        return run_stage(results, name, count, verbose, function, *args, **kwargs)
+
+    total = sum(len(files) for _, _, files in os.walk(root))
+    inventory = stage('scan', total, crawler.scan_repository, root)
+    api_db = stage('classify_apis', len(inventory['rules']),
+                   crawler.classify_apis, os.path.join(root, 'apis'), inventory['rules'], workers)
+    symbols = {}
+    schema_db = stage('classify_schema', len(inventory['schemas']),
+                      crawler.classify_schema, os.path.join(root, 'schemas'), inventory['schemas'], workers, None, None, symbols)
+    stage('generate_schema_pumls', len(inventory['schemas']), crawler.generate_schema_pumls, inventory['schemas'],
+          os.path.join(out_dir, 'schema_puml'))
+    db = stage('join_db', len(inventory['rules']) + len(inventory['schemas']), crawler.join_db, api_db, schema_db)
+    db['links'] = stage('link_index', len(inventory['puml']), crawler.link_index, symbols, inventory['puml'])
+    outputs = stage('modify_puml_files', len(inventory['puml']),
+                    crawler.modify_puml_files, os.path.join(root, 'apis'), puml_dir, db, None, inventory['puml'])
+    outputs += stage('generate_api_files', len(db['api']), crawler.generate_api_files, puml_dir, db)
+    stage('generate_diagrams', len(outputs), crawler.generate_diagrams, puml_dir, svg_dir, workers=workers, files=outputs)
+    stage('compress_svgs', len(outputs), crawler.compress_svgs, svg_dir, workers)
+    stage('make_index', len(db['api']), crawler.make_index, svg_dir, db)
+    stage('make_search_index', len(db['api']) + len(db['schema']), crawler.make_search_index, svg_dir, db)
+    stage('check_links', len(outputs), crawler.check_links, svg_dir, workers)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Number of schema files in each synthetic repository (default: 100 1000 10000)')
+    parser.add_argument('--workers', type=int, default=None, help='Parse and render workers (default: CPU count)')
+    parser.add_argument('--seconds-per-class', type=float, default=0.0,
+                        help='Simulated PlantUML render time per class (default: 0, to measure the overhead alone)')
+    parser.add_argument('--no-memory', action='store_true', help='Do not trace memory (tracing slows the stages down)')
+    parser.add_argument('--verbose', action='store_true', help="Show the crawler's own progress messages")
+    parser.add_argument('--output', default='bench_results.json', help='JSON file to write the results to (default: bench_results.json)')
+    args = parser.parse_args()
+
+    import crawler
+    # Render with the stub, rather than java -jar plantuml.jar
+    crawler.PLANT_JAR = STUB
+    crawler.PLANTUML_CMD = [sys.executable, STUB]
+    os.environ['STUB_SECONDS_PER_CLASS'] = str(args.seconds_per_class)
+
+    report = {'crawler': os.path.abspath(crawler.__file__), 'workers': args.workers or os.cpu_count(),
+              'seconds_per_class': args.seconds_per_class, 'sizes': {}}
+    if not args.no_memory:
+        tracemalloc.start()
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = os.path.join(tmp, 'repository')
+            counts = make_corpus(root, size)
+            print(f'bench_stages: Repository of {counts["rules"]} rules, {counts["schemas"]} schema and {counts["puml"]} PUML files')
+            # The crawler writes some outputs into the current directory
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                report['sizes'][str(size)] = {'files': counts, 'stages': bench(crawler, root, os.path.join(tmp, 'out'), args.workers, args.verbose)}
+            finally:
+                os.chdir(cwd)
+    if not args.no_memory:
+        tracemalloc.stop()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'bench_stages: Results written to [{args.output}]')
+
+
+if __name__ == '__main__':
+    main()
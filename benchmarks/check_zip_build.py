@@ -0,0 +1,77 @@
+"""Check that building from the repository's ZIP download gives exactly the same output as building from the unpacked tree,
+with the files parsed in a pool of several worker processes
+
+Usage:
+    python check_zip_build.py [--size N] [--workers N] [--runs N]
+
+Exits with status 1 (listing the differences) if the databases or the generated PUML files differ.
+"""
+import argparse
+import filecmp
+import json
+import os
+import sys
+import tempfile
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+import crawler
+from make_corpus import make_corpus
+
+
+def build(root: str, out_dir: str, workers: int) -> dict:
+    """Run the crawler stages up to the PUML files over {root}, writing them into {out_dir}, and return the joined database"""
+    os.makedirs(out_dir)
+    inventory = crawler.scan_repository(root)
+    symbols = {}
+    api_db = crawler.classify_apis(os.path.join(root, 'apis'), inventory['rules'], workers)
+    schema_db = crawler.classify_schema(os.path.join(root, 'schemas'), inventory['schemas'], workers, None, None, symbols)
+    db = crawler.join_db(api_db, schema_db)
+    db['links'] = crawler.link_index(symbols, inventory['puml'])
+    crawler.modify_puml_files(os.path.join(root, 'apis'), out_dir, db, None, inventory['puml'])
+    crawler.generate_api_files(out_dir, db)
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=3000, help='Number of schema files (default: 3000)')
+    parser.add_argument('--workers', type=int, default=8, help='Parse workers (default: 8)')
+    parser.add_argument('--runs', type=int, default=3, help='Times to build from the ZIP file (default: 3)')
+    args = parser.parse_args()
+
+    differences = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, 'repository')
+        make_corpus(tree, args.size)
+        archive = os.path.join(tmp, 'repository.zip')
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as f:
+            for directory, _, files in os.walk(tree):
+                for name in files:
+                    path = os.path.join(directory, name)
+                    f.write(path, os.path.relpath(path, tmp))
+
+        expected = build(tree, os.path.join(tmp, 'tree'), args.workers)
+        for run in range(args.runs):
+            out_dir = os.path.join(tmp, f'zip{run}')
+            db = build(os.path.join(archive, 'repository'), out_dir, args.workers)
+            if json.dumps(db, sort_keys=True) != json.dumps(expected, sort_keys=True):
+                differences.append(f'Run {run}: the databases differ')
+            comparison = filecmp.dircmp(os.path.join(tmp, 'tree'), out_dir)
+            for name in comparison.left_only + comparison.right_only:
+                differences.append(f'Run {run}: [{name}] is only built from one of them')
+            _, mismatch, errors = filecmp.cmpfiles(os.path.join(tmp, 'tree'), out_dir, comparison.common_files, shallow=False)
+            for name in mismatch + errors:
+                differences.append(f'Run {run}: [{name}] differs')
+
+    if differences:
+        print('check_zip_build: The ZIP build differs from the tree build:')
+        for difference in differences:
+            print(f' * {difference}')
+        sys.exit(1)
+    print(f'check_zip_build: {args.runs} ZIP builds with {args.workers} workers are identical to the tree build')
+
+
+if __name__ == '__main__':
+    main()
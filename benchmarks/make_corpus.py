@@ -0,0 +1,130 @@
+"""Generate a synthetic repository shaped like the TMForum API repository, for benchmarking without access to it
+
+Usage:
+    python make_corpus.py ROOT [--size N] [--seed N]
+
+For a --size of N this writes N schema files (and the Entity schema they all extend), N // 10 rules files (each with a handful of resources)
+and N // 2 Resource PUML files:
+    ROOT/apis/TMFnnn_<Name>/TMFnnn_<Name>.rules.yaml
+    ROOT/apis/TMFnnn_<Name>/documentation/Resource_<Schema>.puml
+    ROOT/schemas/<Domain>/<Schema>.schema.json
+"""
+import argparse
+import json
+import os
+import random
+
+DOMAINS = ('EngagedParty', 'Customer', 'Product', 'Service', 'Resource', 'Common')
+ATTRIBUTES = 6          # Plain attributes per class, in both schemas and PUML
+PARTS = 3               # Nested definitions per schema (e.g. AgreementItem inside Agreement)
+REFERENCES = 8          # References from each schema to other schemas
+RESOURCES = 5           # Resources per API
+
+
+def schema_names(size: int) -> list:
+    """Return the (domain, name) of each of the {size} schemas"""
+    return [(DOMAINS[i % len(DOMAINS)], f'{DOMAINS[i % len(DOMAINS)]}Entity{i}') for i in range(size)]
+
+
+def make_schema(domain: str, name: str, others: list) -> dict:
+    """Return a JSON schema for {name}, with nested definitions and references to {others} (domain, name)"""
+    definitions = {name: {
+        'description': f'{name} is a synthetic resource, generated to benchmark the diagram site generator. ' * 3,
+        'allOf': [{'$ref': '../Common/Entity.schema.json#Entity'}],
+        'properties': {f'attribute{j}': {'type': 'string', 'description': f'Attribute {j} of {name}'} for j in range(ATTRIBUTES)},
+    }}
+    for k in range(PARTS):
+        part = f'{name}Part{k}'
+        definitions[part] = {'description': f'Part {k} of {name}',
+                             'properties': {f'value{j}': {'type': 'string'} for j in range(ATTRIBUTES)}}
+        definitions[name]['properties'][f'part{k}'] = {'type': 'array', 'items': {'$ref': f'#/definitions/{part}'}}
+    for other_domain, other in others:
+        definitions[name]['properties'][other[0].lower() + other[1:]] = {'$ref': f'../{other_domain}/{other}Ref.schema.json#{other}Ref'}
+    return {'$schema': 'http://json-schema.org/draft-04/schema#', 'definitions': definitions}
+
+
+def make_puml(name: str, others: list) -> str:
+    """Return a Resource PUML file for the {name} schema, like the ones generated in the TMF v4 repository"""
+    lines = ['@startuml', 'hide circle', 'hide methods', 'hide stereotype', 'show <<Enumeration>> stereotype',
+             'skinparam class {', '   BackgroundColor<<Enumeration>> #E6F5F7', '   BackgroundColor<<Ref>> #FFFFE0',
+             '   BackgroundColor<<Pivot>> #FFFFFFF', '}', '', f'class {name} <<Pivot>> {{']
+    lines += [f'    attribute{j} : String' for j in range(ATTRIBUTES)] + ['}', '']
+    for k in range(PARTS):
+        # A reference to a nested definition, which has no diagram of its own (like AgreementItemRef)
+        lines += [f'class {name}Part{k}Ref <<Ref>> {{', '    id : String', '    href : String', '}', '',
+                  f'{name} *-->  "0..*" {name}Part{k}Ref : part{k}', '']
+    for i, (_, other) in enumerate(others):
+        if i % 2:
+            lines += [f'class {other}Ref <<Ref>> {{', '    id : String', '    href : String', '}', '',
+                      f'{name} *-->  "0..1" {other}Ref : ref{i}', '']
+        else:
+            related = 'Related' if i % 4 == 0 else ''
+            lines += [f'class {related}{other}RefOrValue {{', '    id : String', '}', '',
+                      f'{name} *-->  "0..*" {related}{other}RefOrValue : value{i}', '']
+    lines.append('@enduml')
+    return '\n'.join(lines) + '\n'
+
+
+def make_rules(id: int, api_name: str, resources: list) -> str:
+    """Return a rules YAML file for API TMF{id}, exposing {resources}"""
+    lines = ['api:', '  version: 4.0.0', '  doc: |', f'    ## TMF API Reference: TMF{id} - {api_name}', '',
+             '    ### Release : 20.0 - March 2020', '']
+    lines += [f'    {api_name} is a synthetic API, generated to benchmark the diagram site generator.'] * 10
+    lines += [f'  basePath: /tmf-api/{api_name.replace(" ", "")}/v4', '  resources:']
+    lines += [f'    - {resource}' for resource in resources]
+    for resource in resources:
+        lines += [f'  rules {resource}:', '    operations: GET, GET /id, POST, PATCH, DELETE',
+                  f'    notifications: [{resource}CreateEvent, {resource}AttributeValueChangeEvent, {resource}DeleteEvent]',
+                  '    mandatory in post: [name, description]', '    non patchable: [id, href]']
+    return '\n'.join(lines) + '\n'
+
+
+def make_corpus(root: str, size: int, seed: int = 1) -> dict:
+    """Write a synthetic repository of {size} schemas under {root}, returning the number of files of each kind"""
+    rng = random.Random(seed)
+    schemas = schema_names(size)
+    counts = {'rules': 0, 'schemas': 0, 'puml': 0}
+
+    # The parent of every schema (through allOf)
+    os.makedirs(os.path.join(root, 'schemas', 'Common'), exist_ok=True)
+    with open(os.path.join(root, 'schemas', 'Common', 'Entity.schema.json'), 'w') as f:
+        json.dump({'definitions': {'Entity': {'properties': {name: {'type': 'string'} for name in ('id', 'href', '@type', '@baseType')}}}}, f, indent=2)
+    counts['schemas'] += 1
+
+    for domain, name in schemas:
+        directory = os.path.join(root, 'schemas', domain)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'{name}.schema.json'), 'w') as f:
+            json.dump(make_schema(domain, name, rng.sample(schemas, min(REFERENCES, size))), f, indent=2)
+        counts['schemas'] += 1
+
+    for a in range(max(1, size // 10)):
+        id = 600 + a
+        api_name = f'Synthetic {schemas[(a * RESOURCES) % size][1]}'
+        directory = os.path.join(root, 'apis', f'TMF{id}_{api_name.replace(" ", "_")}')
+        resources = [schemas[(a * RESOURCES + r) % size][1] for r in range(RESOURCES)]
+        os.makedirs(os.path.join(directory, 'documentation'), exist_ok=True)
+        with open(os.path.join(directory, f'TMF{id}_{api_name.replace(" ", "_")}.rules.yaml'), 'w') as f:
+            f.write(make_rules(id, api_name, resources))
+        counts['rules'] += 1
+        # Half of the schemas get a Resource diagram
+        for resource in resources:
+            if counts['puml'] < size // 2:
+                with open(os.path.join(directory, 'documentation', f'Resource_{resource}.puml'), 'w') as f:
+                    f.write(make_puml(resource, rng.sample(schemas, min(REFERENCES, size))))
+                counts['puml'] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', help='Directory to write the synthetic repository into')
+    parser.add_argument('--size', type=int, default=1000, help='Number of schema files (default: 1000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    args = parser.parse_args()
+    counts = make_corpus(args.root, args.size, args.seed)
+    print(f'make_corpus: Wrote {counts["rules"]} rules, {counts["schemas"]} schema and {counts["puml"]} PUML files under [{args.root}]')
+
+
+if __name__ == '__main__':
+    main()
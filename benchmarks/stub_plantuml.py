@@ -0,0 +1,75 @@
+"""Stand-in for the PlantUML JAR, so the render stages can be benchmarked without Java
+
+Takes the same command line as PlantUML (see crawler.plantuml_command) and writes an SVG per PUML file into
+the -output directory, with an <a xlink:href> for each [[link]] in the PUML, as PlantUML does.
+With -pipe, it renders each diagram written to its stdin to stdout instead, followed by the -pipedelimitor line.
+Rendering is simulated by sleeping STUB_SECONDS_PER_CLASS (environment variable, default 0) per class.
+"""
+import html
+import os
+import re
+import sys
+import time
+
+LINK = re.compile(r'\[\[(\S+)(?: ([^\]]*))?\]\]')
+CLASS = re.compile(r'^\s*class ', re.MULTILINE)
+
+
+def render(puml: str) -> str:
+    """Return a minimal SVG for {puml}, with its links"""
+    svg = ['<?xml version="1.0" encoding="us-ascii" standalone="no"?>',
+           '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" contentStyleType="text/css" version="1.1">',
+           '<!--stub render-->', '<g>']
+    for y, match in enumerate(LINK.finditer(puml)):
+        href = html.escape(match.group(1))
+        label = html.escape(match.group(2) or match.group(1))
+        svg += [f'<a href="{href}" target="_top" title="{href}" xlink:actuate="onRequest" xlink:href="{href}" xlink:show="new" xlink:title="{href}" xlink:type="simple">',
+                f'  <text fill="#0000FF" font-family="sans-serif" font-size="12.0" x="10.0000" y="{20.0 * (y + 1):.4f}">{label}</text>',
+                '</a>']
+    svg += ['</g>', '</svg>']
+    return '\n'.join(svg) + '\n'
+
+
+def pipe(delimiter: str, seconds_per_class: float):
+    """Render each diagram read from stdin to stdout, as PlantUML -pipe does"""
+    lines = []
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        lines.append(line)
+        if line.startswith('@end'):
+            puml = ''.join(lines)
+            lines = []
+            time.sleep(seconds_per_class * len(CLASS.findall(puml)))
+            # Like PlantUML, the delimiter follows the closing </svg> on the same line
+            sys.stdout.write(render(puml).rstrip('\n') + delimiter + '\n')
+            sys.stdout.flush()
+
+
+def main():
+    args = sys.argv[1:]
+    seconds_per_class = float(os.environ.get('STUB_SECONDS_PER_CLASS', '0'))
+    if '-pipe' in args:
+        pipe(args[args.index('-pipedelimitor') + 1] if '-pipedelimitor' in args else '', seconds_per_class)
+        return
+    out_dir = args[args.index('-output') + 1]
+    returncode = 0
+    for arg in args:
+        if not arg.endswith('.puml'):
+            continue
+        try:
+            with open(arg, encoding='utf-8') as f:
+                puml = f.read()
+        except OSError as e:
+            print(f'Error: cannot read [{arg}]: {e}', file=sys.stderr)
+            returncode = 200
+            continue
+        time.sleep(seconds_per_class * len(CLASS.findall(puml)))
+        with open(os.path.join(out_dir, os.path.basename(arg)[:-len('.puml')] + '.svg'), 'w', encoding='utf-8') as f:
+            f.write(render(puml))
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,198 @@
-from msilib import schema
 import os           # Filesystem
 import re           # Regular Expressions
-import subprocess
-from sys import api_version
-from urllib.parse import scheme_chars   # Ability to exec Java for PlantUML generator
+import subprocess   # Ability to exec Java for PlantUML generator
 import yaml         # Ability to read YAML files
 import json         # Ability to read JSON files
 import textwrap     # Ability to wrap text
 import datetime     # Ability to embed the current date
+import time         # Ability to time the build stages
+import queue        # Ability to hand PUML files from the writers to the renderers
+import threading    # Ability to render while the PUML files are still being written
+import copy         # Ability to copy cached results
+import hashlib      # Ability to fingerprint build inputs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed    # Ability to work in parallel
+from functools import partial, lru_cache
+import io           # Ability to read text from a ZIP member
+import zipfile      # Ability to read the repository straight from its ZIP download
+import shutil       # Ability to copy SVG files in and out of the render cache
+import sys
+import contextlib
+import tracemalloc  # Ability to measure the memory used by each build stage
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler     # Ability to serve the website while it is rebuilt
+import gzip         # Ability to precompress the SVG files for static hosting
+try:
+    import brotli   # Ability to precompress the SVG files with Brotli too, when it is installed
+except ImportError:
+    brotli = None
 
 PLANT_JAR='./plantuml-mit-1.2023.13.jar'
 DOT_EXE='C://Program Files/Graphviz/bin/dot.exe'
+PLANTUML_CMD=['java', '-jar', PLANT_JAR]
+RULES=r'.*\.rules\.yaml$'        # API rules files
+SCHEMA=r'.*\.schema\.json$'      # JSON schema files
+PUML=r'Resource_.*\.puml$'       # Generated PlantUML files for each resource
+YAML_LOADER=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)   # Use the libyaml C parser when it is installed
+BATCH_SIZE=50       # PlantUML files handed to a single JVM (keeps the command line well under the Windows limit)
+BATCH_SECONDS=20    # Stop adding files to a JVM's batch once its estimated render time reaches this
+RENDER_TIMEOUT=300  # Seconds allowed beyond a render's estimated time before PlantUML is killed
+RENDER_RETRIES=1    # Times a diagram that timed out is tried again
+RENDER_CACHE_DIR=os.path.join(os.path.expanduser('~'), '.cache', 'diagram-site-generator', 'svg')   # Shared by all checkouts
+RENDER_CACHE_SIZE=2 * 1024**3   # Bytes of SVG kept in the render cache
 
 def write_json(path: str, root: dict):
     """Dump JSON {root} into {path}"""
     with open(path, 'w') as f:
         json.dump(root, f, indent=2)
 
+def new_build_report(root: str) -> dict:
+    """Start a build report: the timings and file counts of each stage of a build from {root}"""
+    return {'root': root, 'started': datetime.datetime.now().isoformat(timespec='seconds'), 'stages': {}}
+
+OPEN_STAGES=[]      # The stages timed_stage is timing, outermost first
+
+@contextlib.contextmanager
+def timed_stage(report: dict, name: str):
+    """Time the {name} stage of a build into {report}. Yields the stage's dict, for the stage to add its own figures.
+    If tracemalloc is tracing, the stage's peak Python memory is recorded too. Stages can be nested: the peak of
+    an outer stage includes the peaks of the stages inside it"""
+    stage = report['stages'].setdefault(name, {})
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        record_traced_peak(report)
+        stage['peak_traced_bytes'] = 0
+    OPEN_STAGES.append(stage)
+    start = time.perf_counter()
+    try:
+        yield stage
+    finally:
+        stage['seconds'] = time.perf_counter() - start
+        if tracing:
+            record_traced_peak(report)
+        OPEN_STAGES.pop()
+
+def record_traced_peak(report: dict):
+    """Fold tracemalloc's peak so far into the peak of every open stage and of the whole build {report}, then reset it
+    for the next stage - resetting it without doing this would lose the peak of the enclosing stages"""
+    peak = tracemalloc.get_traced_memory()[1]
+    for stage in OPEN_STAGES + [report]:
+        stage['peak_traced_bytes'] = max(stage.get('peak_traced_bytes', 0), peak)
+    tracemalloc.reset_peak()
+
+def peak_rss() -> dict:
+    """Return the peak resident memory of this process (and of its finished children, where the OS reports it) in bytes"""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        # Linux reports kilobytes, macOS bytes
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+                'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return {'self': counters.PeakWorkingSetSize}
+    return {}
+
+def file_size(path: str) -> int:
+    """Return the size of {path} in bytes, or 0 if it doesn't exist"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+MANIFEST_VERSION=1  # Bump whenever the PUML rewriting changes, to force a full rebuild
+
+def load_manifest(path: str) -> dict:
+    """Read the build manifest from {path}, or start an empty one if it is missing or out of date"""
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+        print(f'load_manifest: Build manifest [{path}] is out of date - rebuilding everything')
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'outputs': {}}
+
+def forget_fingerprints(manifest: dict):
+    """Make every output in {manifest} look changed, so it is rewritten and re-rendered. The outputs themselves
+    are kept, so that the ones no longer produced are still found (and removed) by remove_stale_outputs"""
+    for entry in manifest['outputs'].values():
+        entry['inputs'] = entry['rendered'] = None
+
+def fingerprint(*parts) -> str:
+    """Return a stable hash over {parts} - strings, or anything that can be written as JSON"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True)
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def svg_filename(puml_file: str, svg_dir: str) -> str:
+    """Return the SVG file that PlantUML renders {puml_file} into"""
+    name = os.path.splitext(os.path.basename(puml_file))[0]
+    return os.path.join(svg_dir, f'{name}.svg')
+
+def record_output(manifest: dict, out_file: str, inputs: str, **dependencies) -> bool:
+    """Record that {out_file} is built from {inputs} (a fingerprint). Return True if it needs to be (re)written"""
+    entry = manifest['outputs'].get(out_file)
+    if entry and entry['inputs'] == inputs and os.path.exists(out_file):
+        return False
+    manifest['outputs'][out_file] = dict(inputs=inputs, rendered=None, **dependencies)
+    return True
+
+def needs_render(manifest: dict, out_file: str, svg_dir: str) -> bool:
+    """Has {out_file} changed (or lost its SVG) since it was last rendered successfully?"""
+    entry = manifest['outputs'].get(out_file)
+    return entry is None or entry['rendered'] != entry['inputs'] or not os.path.exists(svg_filename(out_file, svg_dir))
+
+def mark_rendered(manifest: dict, results: list):
+    """Record the successful renders from {results} (as returned by generate_diagrams)"""
+    for result in results:
+        entry = manifest['outputs'].get(result['file'])
+        if entry and result['returncode'] == 0:
+            entry['rendered'] = entry['inputs']
+
+def remove_stale_outputs(manifest: dict, outputs: list, svg_dir: str):
+    """Delete every output (PUML and SVG) in {manifest} that is no longer produced, i.e. not in {outputs}"""
+    current = set(outputs)
+    for out_file in [out_file for out_file in manifest['outputs'] if out_file not in current]:
+        svg_file = svg_filename(out_file, svg_dir)
+        for stale in (out_file, svg_file, svg_file + '.gz', svg_file + '.br'):
+            if os.path.exists(stale):
+                print(f'remove_stale_outputs: Removing [{stale}]')
+                os.remove(stale)
+        del manifest['outputs'][out_file]
+
+def dependent_outputs(manifest: dict, sources=(), schemas=(), apis=()) -> list:
+    """Return the outputs in {manifest} built from any of the {sources} files, or using any of the {schemas} or {apis}"""
+    sources, schemas, apis = set(sources), set(schemas), set(apis)
+    return [out_file for out_file, entry in manifest['outputs'].items()
+            if entry.get('source') in sources or schemas.intersection(entry.get('schemas', ())) or apis.intersection(entry.get('apis', ()))]
+
+def source_signatures(inventory: dict) -> dict:
+    """Return the [size, mtime] of every file in {inventory} (from scan_repository), to compare with a later one"""
+    return {file: file_signature(file) for files in inventory.values() for file in files}
+
+def changed_sources(before: dict, after: dict) -> list:
+    """Return the files that were added, removed or modified between two source_signatures"""
+    return sorted(file for file in before.keys() | after.keys() if before.get(file) != after.get(file))
+
 def find_files(path: str, regexp: str) -> list:
     """Return a list of fully-qualified filenames matching {regexp} under {path}"""
 
@@ -39,8 +215,157 @@ def find_files(path: str, regexp: str) -> list:
 
     return files_found
 
-def modify_puml_files(root : str, out_dir: str, db):
-    PUML = 'Resource_.*\.puml$'
+ARCHIVES={}         # Open ZIP archives, by (process id, path) - a forked parse worker must not share its parent's file offset
+
+@lru_cache(maxsize=None)
+def is_archive(path: str) -> bool:
+    """Is {path} a ZIP file (rather than a directory)?"""
+    return path.lower().endswith('.zip') and os.path.isfile(path)
+
+def split_archive_path(path: str) -> tuple:
+    """Split {path} into (archive, member) if it points inside a ZIP file, otherwise return (None, path)"""
+    if '.zip' not in path.lower():
+        return None, path
+    head = path
+    while True:
+        if is_archive(head):
+            member = os.path.relpath(path, head).replace(os.sep, '/') if head != path else ''
+            return head, member
+        parent = os.path.dirname(head)
+        if parent == head or not parent:
+            return None, path
+        head = parent
+
+def open_archive(archive: str) -> zipfile.ZipFile:
+    """Return this process's (shared, already opened) ZipFile for {archive}"""
+    key = (os.getpid(), archive)
+    if key not in ARCHIVES:
+        ARCHIVES[key] = zipfile.ZipFile(archive)
+    return ARCHIVES[key]
+
+def open_input(path: str):
+    """Open the source file {path} for reading as text - either a plain file, or a member inside a ZIP archive
+    (as listed by scan_repository), which is decompressed as it is read"""
+    archive, member = split_archive_path(path)
+    if archive is None:
+        return open(path, 'r')
+    # Decode exactly as open() would, so the output is the same as from an unpacked tree
+    return io.TextIOWrapper(open_archive(archive).open(member), encoding=None)
+
+def input_exists(path: str) -> bool:
+    """Does the source file {path} (plain file or ZIP member) exist?"""
+    archive, member = split_archive_path(path)
+    if archive is None:
+        return os.path.exists(path)
+    try:
+        open_archive(archive).getinfo(member)
+        return True
+    except KeyError:
+        return False
+
+def scan_archive(archive: str, root: str, patterns: dict) -> dict:
+    """scan_repository for a ZIP {archive}: list the members under the {root} directory inside it"""
+    names = [name for name in open_archive(archive).namelist() if not name.endswith('/')]
+    if not root:
+        # GitHub's "Download ZIP" puts everything in one top-level directory - treat that as the root
+        tops = {name.split('/', 1)[0] for name in names}
+        if len(tops) == 1 and all('/' in name for name in names):
+            root = tops.pop()
+    prefix = f'{root}/' if root else ''
+
+    # Visit members in the same order as a directory scan: files then sub-directories, each in name order
+    def scan_order(name):
+        parts = name.split('/')
+        return [(1, part) for part in parts[:-1]] + [(0, parts[-1])]
+
+    inventory = {category: [] for category in patterns}
+    for subdir, categories in SCAN_LAYOUT.items():
+        top = f'{prefix}{subdir}/'
+        members = sorted((name for name in names if name.startswith(top)), key=scan_order)
+        if not members:
+            raise Exception(f'Root directory [{archive}/{top}] does not exist')
+        for name in members:
+            filename = name.rsplit('/', 1)[-1]
+            for category in categories:
+                if patterns[category].search(filename):
+                    inventory[category].append(os.path.join(archive, *name.split('/')))
+
+    print(f'scan_repository: Found {len(inventory["rules"])} rules, {len(inventory["schemas"])} schema and '
+          f'{len(inventory["puml"])} PUML files in [{archive}]')
+    return inventory
+
+SCAN_LAYOUT={'apis': ('rules', 'puml'), 'schemas': ('schemas',)}    # Which files to look for in each repository directory
+
+def scan_repository(root: str, cache_path: str = None, quiet: bool = False) -> dict:
+    """Walk the repository under {root} once, sorting the files found into 'rules', 'schemas' and 'puml' lists
+    (looking in the directories given by SCAN_LAYOUT).
+    Directory listings are cached in {cache_path} against each directory's mtime, so later runs only
+    need to stat a directory rather than list it again. {quiet} leaves out the summary, for polling.
+    {root} may also be the repository's ZIP download (or a directory inside it), which is read without unpacking"""
+    patterns = {'rules': re.compile(RULES), 'schemas': re.compile(SCHEMA), 'puml': re.compile(PUML)}
+    archive, member = split_archive_path(root)
+    if archive is not None:
+        return scan_archive(archive, member, patterns)
+    inventory = {category: [] for category in patterns}
+
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+        except ValueError as e:
+            print(f'scan_repository: Ignoring unreadable scan cache [{cache_path}]: [{e}]')
+    listings = {}
+    relisted = 0
+
+    for subdir, categories in SCAN_LAYOUT.items():
+        path = os.path.join(root, subdir)
+        # Sanity check on {path}
+        if not os.path.exists(path):
+            raise Exception(f'Root directory [{path}] does not exist')
+
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            mtime = os.stat(directory).st_mtime_ns
+            listing = cache.get(directory)
+            if listing is None or listing['mtime'] != mtime:
+                # New or changed directory (a file or sub-directory was added, removed or renamed) - list it again
+                files, dirs = [], []
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                dirs.append(entry.name)
+                        else:
+                            files.append(entry.name)
+                listing = {'mtime': mtime, 'files': sorted(files), 'dirs': sorted(dirs)}
+                relisted += 1
+            listings[directory] = listing
+
+            for name in listing['files']:
+                for category in categories:
+                    if patterns[category].search(name):
+                        inventory[category].append(os.path.join(directory, name))
+            # Depth-first, in name order
+            pending.extend(os.path.join(directory, name) for name in reversed(listing['dirs']))
+
+    if cache_path and listings != cache:
+        # Only the directories seen on this scan are kept, so deleted directories drop out of the cache
+        write_json(cache_path, listings)
+    if not quiet:
+        print(f'scan_repository: Found {len(inventory["rules"])} rules, {len(inventory["schemas"])} schema and '
+          f'{len(inventory["puml"])} PUML files ({relisted} of {len(listings)} directories listed)')
+    return inventory
+
+
+def modify_puml_files(root : str, out_dir: str, db, manifest: dict = None, files: list = None, on_output=None,
+                      stats: dict = None) -> list:
+    """Rewrite every Resource PUML file under {root} (or just {files}, from scan_repository) into {out_dir},
+    returning the list of output files.
+    With a {manifest}, only outputs whose source file or database entries have changed are rewritten.
+    {on_output} is called with each output file as soon as it is up to date.
+    File counts and bytes written are added to {stats}, if given"""
 
     # Sanity check on {out_dir}
     if not os.path.exists(out_dir):
@@ -48,200 +373,1050 @@ def modify_puml_files(root : str, out_dir: str, db):
     if not os.path.isdir(out_dir):
         raise Exception(f'modify_puml_files: Output directory [{out_dir}] exists, but is not a directory')
 
-    puml_files = find_files(root, PUML)
+    puml_files = find_files(root, PUML) if files is None else files
     print(f'Found {len(puml_files)} PUML files')
 
+    outputs = []
+    rewritten = 0
+    bytes_written = 0
     for file in puml_files:
-        modify_puml(file, out_dir, db)
+        out_filename = puml_output_filename(file, out_dir)
+        outputs.append(out_filename)
+        changed = True
+        if manifest is not None:
+            with open_input(file) as puml_handle:
+                content = puml_handle.read()
+            inputs = puml_inputs(content, db)
+            changed = record_output(manifest, out_filename, fingerprint(content, inputs), source=file,
+                                    schemas=sorted(inputs['schemas']), apis=sorted(inputs['apis']))
+        if changed:
+            modify_puml(file, out_dir, db)
+            rewritten += 1
+            if stats is not None:
+                bytes_written += file_size(out_filename)
+        if on_output is not None:
+            on_output(out_filename)
+    print(f'modify_puml_files: Rewrote {rewritten} of {len(puml_files)} PUML files')
+    if stats is not None:
+        stats.update(files=len(puml_files), rewritten=rewritten, bytes_written=bytes_written)
+    return outputs
+
+
+def puml_output_filename(puml_path: str, out_dir: str) -> str:
+    """Return the file that modify_puml writes for {puml_path}: Resource_Thing.puml -> Thing.puml"""
+    return os.path.join(out_dir, re.sub('^Resource_', '', os.path.basename(puml_path)))
+
+
+def puml_inputs(content: str, db) -> dict:
+    """Return the schema_db/api_db details that modify_puml consumes when rewriting PUML {content}"""
+    api_db = db['api']
+    schema_db = db['schema']
+    inputs = {'schemas': {}, 'apis': {}, 'links': {}}
+    # The references link to whichever diagram the link index resolves them to
+    for line in content.splitlines():
+        if line.startswith('class'):
+            match = REF_CLASS.match(line)
+            if match is not None:
+                entity = ref_entity(match.group(1))
+            else:
+                match = RELATED_REF_OR_VALUE.match(line)
+                entity = match.group(3) if match is not None else None
+            if entity:
+                inputs['links'][entity] = link_target(entity, db)
+    # Only the <<Pivot>> classes are decorated from the databases
+    for class_name in re.findall(r'^class\s+(\w+)\s+<<Pivot>>', content, re.MULTILINE):
+        schema_detail = schema_db.get(class_name)
+        if schema_detail is None:
+            continue
+        inputs['schemas'][class_name] = schema_detail
+        id = schema_detail.get('api')
+        if id in api_db:
+            api_detail = api_db[id]
+            inputs['apis'][id] = {key: api_detail[key] for key in ('name', 'version', 'operations', 'notifications') if key in api_detail}
+    return inputs
+
+
+def link_index(symbols: dict, puml_files: list) -> dict:
+    """Return the diagram to link to for each name: the schemas with a Resource PUML file in {puml_files} are
+    linked to their own diagram, and any other definition in {symbols} (from classify_schema) to the first
+    schema with a diagram that defines it - e.g. AgreementItem is in the Agreement diagram"""
+    diagrams = {os.path.splitext(os.path.basename(puml_output_filename(file, '')))[0] for file in puml_files}
+    links = {name: name for name in diagrams}
+    for name, schemas in symbols.items():
+        if name not in links:
+            for schema in schemas:
+                if schema in diagrams:
+                    links[name] = schema
+                    break
+    return links
+
+
+def link_target(entity: str, db) -> str:
+    """Return the diagram that a reference to {entity} should link to, or None if there is no diagram for it.
+    Without a link index in {db} (see link_index), every entity is assumed to have a diagram of its own"""
+    links = db.get('links')
+    if links is None:
+        return entity
+    return links.get(entity)
+
+
+# The PUML rewriting rules, compiled once
+REF = "<<Ref>>"
+PIVOT = "<<Pivot>>"
+#HOST="http://localhost:8000/"
+HOST=""
+CLASS_LINE = re.compile(r'class\s+')
+PIVOT_CLASS = re.compile(rf'class\s+(\w+)\s+{PIVOT}')
+REF_CLASS = re.compile(rf'class\s+(\w+)\s+{REF}')
+RELATED_REF_OR_VALUE = re.compile(rf'class\s+((Related)?(.*)(?:RefOrValue))')
+
+
+def rewrite_pivot(match, line: str, db) -> str:
+    """Rewrite the <<Pivot>> class (the primary resource of the file) with its API, description, operations and notifications"""
+    class_name = match.group(1)
+    api_db = db['api']
+    schema_db = db['schema']
+    if class_name in schema_db:
+        schema_detail = schema_db[class_name]
+        # [{class_name}] is found in the schema_db: [{schema_detail}]
+        if 'api' in schema_detail:
+            api_name = api_version = ''
+            id = schema_detail['api']
+            # print(f'* modify_puml: Found [{class_name}] in api_db related to TMF [{id}]: ')
+            # Need to extract name, operations and notifications from that API detail
+            if id in api_db:
+                api_detail = api_db[id]
+                # Found TMF-API [{id}] related to schema [{class_name}] in api_db: [{api_detail}]
+                if 'version' in api_detail:
+                    # Found TMF-API [{id}] related to schema [{class_name}] in api_db with version [{api_version}]
+                    api_version = api_detail['version']
+                if 'name' in api_detail:
+                    # Found TMF-API [{id}] related to schema [{class_name}] in api_db with name [{api_name}]
+                    api_name = api_detail['name']
+
+                if 'operations' in api_detail:
+                    methods = f'\n   {api_detail["operations"]}\n  ..'
+                else:
+                    methods = ""
+
+                if 'notifications' in api_detail:
+                    notifications = api_detail['notifications']
+                    # print(f'Found [{class_name}] in api_details with notifications: [{notifications}], type [{type(notifications)}], length [{len(notifications)}]')
+                    if type(notifications) is str:
+                        # If there are no spaces, the csv are taken as a single value string
+                        notifications = notifications.split(',')
+                    notification_label = "\n  .."
+                    for notification in notifications:
+                        notification_label = f'\n  {notification}{notification_label}'
+                else:
+                    notification_label = ""
+                if 'description' in schema_detail:
+                    description = schema_detail["description"]
+                    # Wrap this description to 80 character width - to make a wide resource box
+                    description = textwrap.fill(description, 45, break_long_words=False, replace_whitespace=True)
+                    description = description.replace('\n', '\n<font size=9><i>')
+                    description = f'\n  <font size=9><i>{description}\n  ..'
+                else:
+                    # print(f'* Found [{class_name}] in api_details but it has no description: [{schema_detail}]')
+                    description = ""
+
+                class_title = f'\"{class_name}\\n(<font size=9><i>from [[{HOST}TMF{id}.svg TMF{id}-{api_name}]] v{api_version}</i>)\" as {class_name} {PIVOT} {{'
+                # Rewriting the line:\n    {line}\n    as:\n    class {class_title}
+                line = f'class {class_title}{description}{methods}{notification_label}'
+#            else:
+#                print(f'* Found [{class_name}] in api_db but it is not in api_db: [{schema_detail}]')
+#        else:
+#            print(f'* Found [{class_name}] is in schema_db but has no TMF API ("api" attribute): [{schema_detail}]')
+#    else:
+#        print(f'* [{class_name}] from PUML file is not directly mentioned in any API rules file')
+    return line
+
+
+def ref_entity(class_name: str) -> str:
+    """Return the entity that an "<Entity>Ref" class refers to"""
+    return class_name[:-len('Ref')] if class_name.endswith('Ref') else class_name
+
+
+def rewrite_ref(match, line: str, db) -> str:
+    """Rewrite an "<Entity>Ref" class to link to the diagram of <Entity> (left as-is if there isn't one)"""
+    class_name = match.group(1)
+    entity = ref_entity(class_name)
+    target = link_target(entity, db)
+    if target is None:
+        return line
+    return f'class \"[[{HOST}{target}.svg {entity}]]Ref\" as {class_name} {REF} {{'
+
+
+def rewrite_ref_or_value(match, line: str, db) -> str:
+    """Rewrite a "(Related)<Entity>RefOrValue" class to link to the diagram of <Entity> (left as-is if there isn't one)"""
+    related = match.group(2) or ""
+    entity = match.group(3) or ""
+    # print(f'* Match [{match.group(0)}] is a (Related)Entity(RefOrValue) with a Class name [{entity}]')
+    target = link_target(entity, db)
+    if target is None:
+        return line
+    return f'class \"{related}[[{HOST}{target}.svg {entity}]]RefOrValue\" as {related}{entity}RefOrValue {{'
+
+
+# Class definitions are rewritten by the first rule whose pattern matches (a matched rule may leave the line as-is)
+CLASS_RULES = (
+    (PIVOT_CLASS, rewrite_pivot),
+    (REF_CLASS, rewrite_ref),
+    (RELATED_REF_OR_VALUE, rewrite_ref_or_value),
+)
 
 
 def modify_puml(puml_path: str, out_dir: str, db):
     """Modify the PUML files in {puml_path} to add hyperlinks, descriptions etc, then write to {out_dir} directory"""
     # Sanity check on {puml_path}
-    if not os.path.exists(puml_path):
+    if not input_exists(puml_path):
         raise Exception(f'PlantUML file [{puml_path}] does not exist')
 
-    # Sanity check on location of the PlantUML generator
-    if not os.path.exists(PLANT_JAR):
-        raise Exception(f'PlantUML JAR file [{PLANT_JAR}] does not exist')
+    # A bit early in the file, but inject a title after @startuml
+    header = f'\ntitle TMF Schema Class Diagram\n'
+    header += f'\nlegend\n[[index.htm Go to API Catalog]]\nend legend\n'
+    header += f'header Diagram generated on {datetime.datetime.now().strftime("%x")}\n\n'
 
-    # print(f'Reading PlantUML file [{puml_path}]')
-    with open(puml_path, 'r') as puml_handle:
-        # removing the newline characters
-        puml_lines = [line.rstrip() for line in puml_handle]
-
-    REF = "<<Ref>>"
-    PIVOT = "<<Pivot>>"
-    RELATED = "Related"
-    REFORVALUE = "RefOrValue"
-    #HOST="http://localhost:8000/"
-    HOST=""
-    class_definition = re.compile(f'^class\s+(\w+)\s+({REF}|{PIVOT})')
-    related_ref_or_value = re.compile(f'^class\s+((Related)?(.*)(?:RefOrValue))')
-
-    # Open a PUML file for wriing into the modifed directory
-    in_filename = os.path.basename(puml_path)
-    in_filename = re.sub('^Resource_', '', in_filename)
-    out_filename = os.path.join(out_dir, in_filename)
-    if os.path.exists(out_filename):
-        os.remove(out_filename)
-
-    modified_puml = open(out_filename, "x")
+    # Stream the PUML file line by line into a PUML file in the modified directory
+    out_filename = puml_output_filename(puml_path, out_dir)
+    with open_input(puml_path) as puml_handle, open(out_filename, 'w') as modified_puml:
+        for line in puml_handle:
+            # removing the newline characters
+            line = line.rstrip()
+            # Only lines that start with the right keyword are worth a regex
+            if line.startswith('@startuml'):
+                line += header
+            elif line.startswith('class') and CLASS_LINE.match(line):
+                # {line} is a class definition, looking closer...
+                for pattern, rewrite in CLASS_RULES:
+                    match = pattern.match(line)
+                    if match is not None:
+                        line = rewrite(match, line, db)
+                        break
+            modified_puml.write(line + '\n')
+    return out_filename
 
-    api_db = db['api']
-    schema_db = db['schema']
 
-    for line in puml_lines:
-        if re.search('^@startuml', line):
-            # A bit early in the file, but inject a title
-            line += f'\ntitle TMF Schema Class Diagram\n'
-            line += f'\nlegend\n[[index.htm Go to API Catalog]]\nend legend\n'
-            line += f'header Diagram generated on {datetime.datetime.now().strftime("%x")}\n\n'
-        if re.search('^class\s+', line):
-            # {line} is a class definition, looking closer...
-            match = re.search(class_definition, line)
-            if match != None:
-                class_name = match.group(1)
-                class_type = match.group(2)
-                # Match [{match.group(0)}] has Class name [{class_name}] and stereotype [{class_type}]
-                if class_type == PIVOT:
-                    # [{line}] describes the primary resource of this file
-                    if class_name in schema_db:
-                        schema_detail = schema_db[class_name]
-                        # [{class_name}] is found in the schema_db: [{schema_detail}]
-                        if 'api' in schema_detail:
-                            api_name = api_version = ''
-                            id = schema_detail['api']
-                            # print(f'* modify_puml: Found [{class_name}] in api_db related to TMF [{id}]: ')
-                            # Need to extract name, operations and notifications from that API detail
-                            if id in api_db:
-                                api_detail = api_db[id]
-                                # Found TMF-API [{id}] related to schema [{class_name}] in api_db: [{api_detail}]
-                                if 'version' in api_detail:
-                                    # Found TMF-API [{id}] related to schema [{class_name}] in api_db with version [{api_version}]
-                                    api_version = api_detail['version']
-                                if 'name' in api_detail:
-                                    # Found TMF-API [{id}] related to schema [{class_name}] in api_db with name [{api_name}]
-                                    api_name = api_detail['name']
-
-                                if 'operations' in api_detail:
-                                    methods = f'\n   {api_detail["operations"]}\n  ..'
-                                else:
-                                    methods = ""
-
-                                if 'notifications' in api_detail:
-                                    notifications = api_detail['notifications']
-                                    # print(f'Found [{class_name}] in api_details with notifications: [{notifications}], type [{type(notifications)}], length [{len(notifications)}]')
-                                    if type(notifications) is str:
-                                        # If there are no spaces, the csv are taken as a single value string
-                                        notifications = notifications.split(',')
-                                    notification_label = "\n  .."
-                                    for notification in notifications:
-                                        notification_label = f'\n  {notification}{notification_label}'
-                                else:
-                                    notification_label = ""
-                                if 'description' in schema_detail:
-                                    description = schema_detail["description"]
-                                    # Wrap this description to 80 character width - to make a wide resource box
-                                    description = textwrap.fill(description, 45, break_long_words=False, replace_whitespace=True)
-                                    description = re.sub('\n', '\n<font size=9><i>', description)
-                                    description = f'\n  <font size=9><i>{description}\n  ..'
-                                else:
-                                    # print(f'* Found [{class_name}] in api_details but it has no description: [{schema_detail}]')
-                                    description = ""
-
-                                class_title = f'\"{class_name}\\n(<font size=9><i>from [[{HOST}TMF{id}.svg TMF{id}-{api_name}]] v{api_version}</i>)\" as {class_name} {PIVOT} {{'
-                                # Rewriting the line:\n    {line}\n    as:\n    class {class_title}
-                                line = f'class {class_title}{description}{methods}{notification_label}'
-#                            else:
-#                                print(f'* Found [{class_name}] in api_db but it is not in api_db: [{schema_detail}]')
-#                        else:
-#                            print(f'* Found [{class_name}] is in schema_db but has no TMF API ("api" attribute): [{schema_detail}]')
-#                    else:
-#                        print(f'* [{class_name}] from PUML file is not directly mentioned in any API rules file')
-
-                elif class_type == REF:
-                    # Found "<Entity>Ref"
-                    entity = re.sub('Ref$', '', class_name)
-                    # Rewriting the line
-                    line = f'class \"[[{HOST}{entity}.svg {entity}]]Ref\" as {class_name} {REF} {{'
-#                else:
-#                    print(f'* The line:[{line}]\n  * With a class name [{class_name}] is not a {PIVOT} or {REF}')
-            else:
-                # print(f'[{line}] is not a <Ref> or a <Pivot> - so looking for (Related)ThingRefOrValue')
-                match = re.search(related_ref_or_value, line)
-                if match != None:
-                    # Found "(Related)<Entity>RefOrValue"
-                    related = match.group(2) or ""
-                    entity = match.group(3) or ""
-                    # print(f'* Match [{match.group(0)}] is a (Related)Entity(RefOrValue) with a Class name [{entity}]')
-                    # print(f'* Groups [{match.groups()}]')
-                    line = f'class \"{related}[[{HOST}{entity}.svg {entity}]]RefOrValue\" as {related}{entity}RefOrValue {{'
-#                else:
-#                    print(f'* No match for line [{line}]')
-#        print(f'Writing line: [{line}]')
-        modified_puml.write(line + '\n')
-    modified_puml.close()
-
-
-def generate_diagrams(puml_path: str, svg_dir: str):
+def plantuml_command(puml_files: list, svg_dir: str) -> list:
+    """Return the PlantUML command line that renders all of {puml_files} as SVG into {svg_dir}"""
+    # PlantUML resolves a relative -output against each input file, so pin it down
+    return PLANTUML_CMD + ['-graphvizdot', DOT_EXE] + puml_files + \
+        ['-output', os.path.abspath(svg_dir), '-Djava.awt.headless=true', '-nometadata', '-tsvg', '-v']
+
+
+def load_render_costs(path: str) -> dict:
+    """Read the render times recorded by earlier builds from {path} (if there are any)"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'seconds_per_unit': 0.01, 'files': {}}
+
+
+def render_cost_units(puml_file: str) -> float:
+    """Estimate the layout work in {puml_file} from its classes, relations and size - Graphviz time grows with each"""
+    classes = relations = size = 0
+    with open(puml_file, 'r') as f:
+        for line in f:
+            size += len(line)
+            if line.startswith('class '):
+                classes += 1
+            elif '--' in line or '..' in line:
+                relations += 1
+    return classes + 2 * relations + size / 1000
+
+
+def estimate_render_seconds(puml_file: str, units: float, costs: dict) -> float:
+    """Estimate how long {puml_file} ({units} of work) takes to render, from {costs} (see load_render_costs)"""
+    recorded = costs['files'].get(os.path.basename(puml_file))
+    if recorded and recorded['units']:
+        # Scale the last actual render time by how much the diagram has changed since
+        return recorded['seconds'] * units / recorded['units']
+    return units * costs['seconds_per_unit']
+
+
+def record_render_costs(costs: dict, results: list):
+    """Remember the actual render times in {results}, to improve the estimates of the next build.
+    Failed renders are left out: a diagram that timed out would otherwise record its whole allowance, and be allowed
+    (and scheduled) longer on every build. A batch's time is only known for the batch as a whole, so it improves the
+    overall rate, but a diagram's own time is only recorded when it was rendered alone"""
+    for result in results:
+        if result.get('units') and result['returncode'] == 0:
+            if result.get('alone'):
+                costs['files'][os.path.basename(result['file'])] = {'units': result['units'], 'seconds': result['seconds']}
+            # A slowly moving average, so one odd render doesn't throw the estimates
+            rate = result['seconds'] / result['units']
+            costs['seconds_per_unit'] = 0.9 * costs['seconds_per_unit'] + 0.1 * rate
+
+
+def render_chunk(puml_files: list, svg_dir: str, timeout: float = None, weights: dict = None, retries: int = RENDER_RETRIES,
+                 cache: dict = None, estimates: dict = None) -> list:
+    """Render {puml_files} in a single PlantUML JVM, returning a result dict per file.
+    The JVM is killed once it runs {timeout} seconds past the estimated render time of its files ({estimates}, file -> seconds),
+    so one diagram that hangs is caught after about {timeout} seconds, however big the batch. A batch that fails is
+    rendered one file at a time, and a single file that times out is retried {retries} times.
+    The time taken is shared between the files by their {weights} (file -> cost units).
+    Successfully rendered SVGs are added to the render {cache}, if given"""
+    estimates = estimates or {}
+    chunk_timeout = timeout + sum(estimates.get(file, 0) for file in puml_files) if timeout else None
+    timed_out = False
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run(plantuml_command(puml_files, svg_dir), capture_output=True, text=True,
+                                   errors='replace', timeout=chunk_timeout)
+        returncode = completed.returncode
+        error = completed.stderr.strip()
+    except subprocess.TimeoutExpired:
+        returncode = None
+        error = f'Timed out after {chunk_timeout:.0f}s'
+        timed_out = True
+    except OSError as e:
+        # Java itself could not be started - every file in the chunk has failed
+        returncode = None
+        error = str(e)
+    elapsed = time.perf_counter() - start
+
+    if returncode != 0 and (returncode is not None or timed_out):
+        if len(puml_files) > 1:
+            # PlantUML reports one exit code for the whole batch, so render each file alone to find the culprit(s)
+            results = []
+            for file in puml_files:
+                results += render_chunk([file], svg_dir, timeout, weights, retries, cache, estimates)
+            return results
+        if timed_out and retries > 0:
+            print(f'render_chunk: [{puml_files[0]}] timed out after {chunk_timeout:.0f}s - retrying')
+            return render_chunk(puml_files, svg_dir, timeout, weights, retries - 1, cache, estimates)
+
+    if returncode == 0 and cache is not None:
+        for file in puml_files:
+            store_render(file, svg_dir, cache)
+
+    weights = weights or {}
+    total = sum(weights.get(file, 1) for file in puml_files) or 1
+    return [{'file': file, 'returncode': returncode, 'error': error if returncode != 0 else '',
+             'seconds': elapsed * weights.get(file, 1) / total, 'units': weights.get(file), 'alone': len(puml_files) == 1}
+            for file in puml_files]
+
+
+def open_render_cache(cache_dir: str = RENDER_CACHE_DIR, max_bytes: int = RENDER_CACHE_SIZE) -> dict:
+    """Return a render cache of finished SVGs in {cache_dir}, keyed by the content of the PlantUML they came from.
+    The directory can be shared by several builds at once"""
+    os.makedirs(cache_dir, exist_ok=True)
+    return {'dir': cache_dir, 'max_bytes': max_bytes, 'keys': {}, 'hits': 0, 'misses': 0}
+
+
+def render_cache_key(puml_file: str) -> str:
+    """Hash the PlantUML in {puml_file}, leaving out the 'Diagram generated on' date, which changes every day"""
+    digest = hashlib.sha256()
+    # A different PlantUML version may draw the same diagram differently
+    digest.update(os.path.basename(PLANT_JAR).encode('utf-8'))
+    with open(puml_file, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'header Diagram generated on '):
+                digest.update(line)
+    return digest.hexdigest()
+
+
+def render_cache_path(cache: dict, key: str) -> str:
+    """Return where the SVG for {key} lives in the render {cache}"""
+    return os.path.join(cache['dir'], key[:2], f'{key}.svg')
+
+
+def cached_render(puml_file: str, svg_dir: str, cache: dict):
+    """Copy the SVG for {puml_file} out of the render {cache}, returning its result dict - or None if it isn't cached"""
+    key = cache['keys'][puml_file] = render_cache_key(puml_file)
+    cached = render_cache_path(cache, key)
+    try:
+        shutil.copyfile(cached, svg_filename(puml_file, svg_dir))
+        # Touch the entry, so it is the last to be evicted
+        os.utime(cached)
+    except FileNotFoundError:
+        cache['misses'] += 1
+        return None
+    cache['hits'] += 1
+    return {'file': puml_file, 'returncode': 0, 'error': '', 'seconds': 0.0, 'units': None, 'cached': True}
+
+
+def store_render(puml_file: str, svg_dir: str, cache: dict):
+    """Add the SVG just rendered from {puml_file} to the render {cache}"""
+    key = cache['keys'].get(puml_file) or render_cache_key(puml_file)
+    cached = render_cache_path(cache, key)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    # Copy then rename, so another build never sees half an SVG
+    temp = f'{cached}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        shutil.copyfile(svg_filename(puml_file, svg_dir), temp)
+        os.replace(temp, cached)
+    except OSError as e:
+        # e.g. another build is reading the same entry (on Windows) - it is cached already
+        print(f'store_render: Unable to cache the SVG for [{puml_file}]: [{e}]')
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def close_render_cache(cache: dict):
+    """Report the hit rate of the render {cache}, then evict the least recently used SVGs until it fits its size limit"""
+    lookups = cache['hits'] + cache['misses']
+    if lookups:
+        print(f'close_render_cache: {cache["hits"]} of {lookups} diagrams were in the render cache ({100 * cache["hits"] / lookups:.0f}% hit rate)')
+
+    entries = []
+    for root, dirs, files in os.walk(cache['dir']):
+        for name in files:
+            if name.endswith('.svg'):
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue    # Evicted by another build
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= cache['max_bytes']:
+            break
+        try:
+            os.remove(path)
+            evicted += 1
+        except OSError:
+            pass    # Already evicted, or in use by another build
+        total -= size
+    if evicted:
+        print(f'close_render_cache: Evicted {evicted} SVGs, leaving {total / 1024**2:.0f}MB in [{cache["dir"]}]')
+
+
+def schedule_renders(puml_files: list, costs: dict) -> tuple:
+    """Return {puml_files} longest-to-render first - so a big diagram can't start last and hold up the end
+    of the build - with the cost units and estimated render seconds of each file"""
+    units = {file: render_cost_units(file) for file in puml_files}
+    seconds = {file: estimate_render_seconds(file, units[file], costs) for file in puml_files}
+    return sorted(puml_files, key=lambda file: seconds[file], reverse=True), units, seconds
+
+
+def generate_diagrams(puml_path: str, svg_dir: str, batch: bool = True, workers: int = None, files: list = None,
+                      timeout: float = RENDER_TIMEOUT, costs: dict = None, cache: dict = None, stats: dict = None) -> list:
     """Take a directory of PlantUML files and generate an output directory of SVG files
 
     Args:
         puml_path (puml_dir): _Directory of PlantUML files_
         out_dir (svg_dir): _Output directory of SVG files_
+        batch (bool): _Render several files per JVM (up to BATCH_SIZE, or BATCH_SECONDS of work), rather than one JVM per file_
+        workers (int): _Number of JVMs to run at once (default: CPU count)_
+        files (list): _Only render these PlantUML files, rather than everything in {puml_path}_
+        timeout (float): _Seconds allowed per JVM beyond the estimated render time of its diagrams_
+        costs (dict): _Render times from earlier builds (see load_render_costs), updated with this build's times_
+        cache (dict): _Render cache (see open_render_cache) to take SVGs from, rather than render them again_
+        stats (dict): _Dict to add the file counts, JVM time, bytes written and per-file render times to_
+
+    Returns:
+        list: _A result dict (file, returncode, error, seconds) per PlantUML file_
     """
-    puml_files = find_files(puml_path, f'.*\.puml$')
+    puml_files = find_files(puml_path, r'.*\.puml$') if files is None else files
+    total = len(puml_files)
+
+    results = []
+    if cache is not None:
+        # Only render what isn't in the cache
+        to_render = []
+        for file in puml_files:
+            result = cached_render(file, svg_dir, cache)
+            if result is None:
+                to_render.append(file)
+            else:
+                results.append(result)
+                report_render(result, f'{len(results)}/{total}')
+        puml_files = to_render
+
+    # Sanity check on location of the PlantUML generator
+    if puml_files and not os.path.exists(PLANT_JAR):
+        raise Exception(f'PlantUML JAR file [{PLANT_JAR}] does not exist')
+    workers = workers or os.cpu_count() or 1
+    costs = costs if costs is not None else load_render_costs('')
+    ordered, units, seconds = schedule_renders(puml_files, costs)
+
+    # Batch up the files, most expensive first. Keep batches small enough that there are plenty for the workers
+    chunk_size = BATCH_SIZE if batch else 1
+    chunk_seconds = min(BATCH_SECONDS, sum(seconds.values()) / workers)
+    chunks = []
+    for file in ordered:
+        if not chunks or len(chunks[-1]) >= chunk_size or sum(seconds[f] for f in chunks[-1]) >= chunk_seconds:
+            chunks.append([])
+        chunks[-1].append(file)
+
+    print(f'generate_diagrams: Rendering {len(puml_files)} PlantUML files with {workers} workers ({len(chunks)} JVMs)')
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(render_chunk, chunk, svg_dir, timeout, units, RENDER_RETRIES, cache, seconds)
+                   for chunk in chunks]
+        for future in as_completed(futures):
+            for result in future.result():
+                results.append(result)
+                report_render(result, f'{len(results)}/{total}')
+
+    record_render_costs(costs, results)
+    if stats is not None:
+        record_render_stats(stats, results, svg_dir)
+    report_renders('generate_diagrams', results, time.perf_counter() - start)
+    return results
+
+
+def record_render_stats(stats: dict, results: list, svg_dir: str):
+    """Add the file counts, JVM time, SVG bytes written and per-file render times of {results} to {stats}"""
+    rendered = [result for result in results if not result.get('cached')]
+    stats['files'] = len(results)
+    stats['cached'] = len(results) - len(rendered)
+    stats['failed'] = sum(1 for result in results if result['returncode'] != 0)
+    # Each JVM's time is shared out between its files, so this adds up to the total JVM time
+    stats['jvm_seconds'] = sum(result['seconds'] for result in rendered)
+    stats['bytes_written'] = sum(file_size(svg_filename(result['file'], svg_dir)) for result in results if result['returncode'] == 0)
+    stats['render_seconds'] = {result['file']: result['seconds'] for result in rendered}
+
+
+def report_render(result: dict, progress: str):
+    """Print the progress line for one rendered PlantUML file"""
+    if result['returncode'] != 0:
+        status = f'FAILED (exit code {result["returncode"]})'
+    else:
+        status = 'OK (cached)' if result.get('cached') else 'OK'
+    print(f'[{progress}] {status} {result["file"]}')
+
+
+def report_renders(caller: str, results: list, elapsed: float):
+    """Print the summary of a render stage, listing the PlantUML files that failed"""
+    failures = [result for result in results if result['returncode'] != 0]
+    print(f'{caller}: Rendered {len(results) - len(failures)}/{len(results)} PlantUML files in {elapsed:.1f}s')
+    for failure in failures:
+        print(f'* Failed to render [{failure["file"]}] (exit code {failure["returncode"]}):\n  {failure["error"]}')
 
-    for file in puml_files:
-        # -nbthread auto
-        cmd = f'java -jar {PLANT_JAR} -graphvizdot \"{DOT_EXE}\" \"{file}\" -output \"{svg_dir}\" -Djava.awt.headless=true -nometadata -tsvg -v'
-        print(f'Generating diagram from PlantUML [{file}]:\n  {cmd}')
-        subprocess.run(cmd)
 
+def render_pipeline(svg_dir: str, produce, batch: bool = True, workers: int = None,
+                    timeout: float = RENDER_TIMEOUT, costs: dict = None, cache: dict = None, stats: dict = None) -> list:
+    """Render PlantUML files into {svg_dir} while they are still being written.
 
-def classify_schema(root: str):
-    """Extract details (domain) from all schema files. Correlate with known API resources"""
-    SCHEMA= '.*\.schema\.json$'
-    schema_files = find_files(root, SCHEMA)
+    {produce} is called (in this thread) with a submit(puml_file) callback, and should submit each
+    PlantUML file as soon as it is written. Meanwhile {workers} render threads take whatever has been
+    submitted - the most expensive first, up to BATCH_SIZE files or BATCH_SECONDS of work at a time -
+    and render it in one JVM. The queue between them is bounded, so {produce} waits if it gets too far
+    ahead of the renderers. {timeout}, {costs}, {cache} and {stats} are as for generate_diagrams.
 
+    Returns:
+        list: _A result dict (file, returncode, error, seconds) per PlantUML file_
+    """
+    # Sanity check on location of the PlantUML generator
+    if not os.path.exists(PLANT_JAR):
+        raise Exception(f'PlantUML JAR file [{PLANT_JAR}] does not exist')
+    workers = workers or os.cpu_count() or 1
+    costs = costs if costs is not None else load_render_costs('')
+    chunk_size = BATCH_SIZE if batch else 1
+    # Queued as (-estimated seconds, sequence, file), so the most expensive file comes out first
+    pending = queue.PriorityQueue(maxsize=workers * chunk_size)
+    units = {}
+    estimates = {}
+    sequence = 0
+    END = (float('inf'), 0, None)   # Sorts after every file
+    results = []
+    lock = threading.Lock()
+
+    def submit(file):
+        nonlocal sequence
+        if cache is not None:
+            result = cached_render(file, svg_dir, cache)
+            if result is not None:
+                with lock:
+                    results.append(result)
+                    report_render(result, f'{len(results)}')
+                return
+        units[file] = render_cost_units(file)
+        estimates[file] = estimate_render_seconds(file, units[file], costs)
+        sequence += 1
+        pending.put((-estimates[file], sequence, file))
+
+    def render_worker():
+        done = False
+        while not done:
+            # Wait for one file, then take whatever else is ready (up to a full batch)
+            chunk = [pending.get()]
+            while len(chunk) < chunk_size and chunk[-1][2] is not None and -sum(item[0] for item in chunk) < BATCH_SECONDS:
+                try:
+                    chunk.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            if chunk[-1][2] is None:
+                # End of the files - finish this chunk and stop
+                chunk.pop()
+                done = True
+            if chunk:
+                files = [item[2] for item in chunk]
+                try:
+                    chunk_results = render_chunk(files, svg_dir, timeout, units, RENDER_RETRIES, cache, estimates)
+                except Exception as e:
+                    # Fail this chunk but keep draining the queue - a dead worker would leave {produce} blocked on it
+                    chunk_results = [{'file': file, 'returncode': None, 'error': f'{type(e).__name__}: {e}',
+                                      'seconds': 0, 'units': None} for file in files]
+                for result in chunk_results:
+                    with lock:
+                        results.append(result)
+                        report_render(result, f'{len(results)}')
+
+    print(f'render_pipeline: Rendering PlantUML files with {workers} workers (up to {chunk_size} per JVM)')
+    start = time.perf_counter()
+    threads = [threading.Thread(target=render_worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        produce(submit)
+    finally:
+        # One end marker per worker - each worker stops when it takes one
+        for _ in threads:
+            pending.put(END)
+        for thread in threads:
+            thread.join()
+
+    record_render_costs(costs, results)
+    if stats is not None:
+        record_render_stats(stats, results, svg_dir)
+    report_renders('render_pipeline', results, time.perf_counter() - start)
+    return results
+
+
+PIPE_DELIMITER='@@end-of-diagram@@'    # Written by PlantUML -pipe after each diagram
+
+def open_plantuml_pipe() -> dict:
+    """Return a warm PlantUML renderer for pipe_render: one JVM that renders every diagram written to its stdin,
+    so the JVM start-up is only paid once. The JVM is started on the first render (and again if it dies)"""
+    return {'process': None, 'rendered': 0}
+
+
+def pipe_render(pipe: dict, puml_file: str, svg_dir: str, timeout: float = RENDER_TIMEOUT) -> dict:
+    """Render {puml_file} into {svg_dir} through the warm PlantUML {pipe}, returning a result dict like render_chunk's"""
+    start = time.perf_counter()
+    process = pipe['process']
+    if process is None or process.poll() is not None:
+        command = PLANTUML_CMD + ['-graphvizdot', DOT_EXE, '-pipe', '-pipedelimitor', PIPE_DELIMITER, '-charset', 'UTF-8',
+                                  '-Djava.awt.headless=true', '-nometadata', '-tsvg']
+        process = pipe['process'] = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                     stderr=subprocess.DEVNULL, text=True, encoding='utf-8')
+    # A diagram that hangs PlantUML takes the JVM with it - the next render starts another
+    watchdog = threading.Timer(timeout, process.kill)
+    watchdog.start()
+    returncode, error = 0, ''
+    try:
+        # The PUML files are written in the platform's encoding (as the batch renders read them), but go down the pipe as UTF-8
+        with open(puml_file, 'r') as f:
+            process.stdin.write(f.read().rstrip('\n') + '\n')
+        process.stdin.flush()
+        svg = []
+        while True:
+            line = process.stdout.readline()
+            if not line:
+                raise OSError(f'PlantUML stopped (exit code {process.poll()})')
+            # PlantUML writes the delimiter straight after the closing </svg>, on the same line
+            line = line.rstrip('\n')
+            if line.endswith(PIPE_DELIMITER):
+                svg.append(line[:-len(PIPE_DELIMITER)])
+                break
+            svg.append(line + '\n')
+        with open(svg_filename(puml_file, svg_dir), 'w', encoding='utf-8') as f:
+            f.write(''.join(svg))
+        pipe['rendered'] += 1
+    except (OSError, ValueError) as e:
+        returncode, error = None, str(e)
+        process.kill()
+    finally:
+        watchdog.cancel()
+    return {'file': puml_file, 'returncode': returncode, 'error': error, 'seconds': time.perf_counter() - start, 'units': None}
+
+
+def close_plantuml_pipe(pipe: dict):
+    """Stop the JVM of the PlantUML {pipe}, if it was started"""
+    process = pipe['process']
+    if process is not None and process.poll() is None:
+        process.stdin.close()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    print(f'close_plantuml_pipe: Rendered {pipe["rendered"]} diagrams through the warm PlantUML JVM')
+
+
+def parse_file(parser, path: str) -> tuple:
+    """Run {parser} on {path}, returning (result, None, seconds) or (None, error message, seconds) if it fails"""
+    start = time.perf_counter()
+    try:
+        return parser(path), None, time.perf_counter() - start
+    except Exception as e:
+        return None, str(e), time.perf_counter() - start
+
+
+def parse_files(parser, files: list, workers: int = None) -> list:
+    """Run {parser} over each of {files} - in a process pool if more than one worker - returning a
+    (result, error, seconds) tuple per file, in the same order as {files}"""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(files) < 2:
+        return [parse_file(parser, file) for file in files]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Hand out the files in chunks, so the pool isn't dominated by inter-process traffic
+        chunksize = max(1, len(files) // (workers * 4))
+        return list(pool.map(partial(parse_file, parser), files, chunksize=chunksize))
+
+
+PARSER_VERSION=2    # Bump whenever analyse_rules_file or analyse_schema_file change what they extract
+
+def load_parse_cache(path: str) -> dict:
+    """Read the parse cache from {path}, or start an empty one if it is missing or from another PARSER_VERSION"""
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+        if cache.get('version') == PARSER_VERSION:
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {'version': PARSER_VERSION, 'rules': {}, 'schemas': {}}
+
+
+def file_signature(path: str) -> list:
+    """Return the [size, mtime] of {path}, which identify an unchanged file in the parse cache.
+    ZIP members use their CRC in place of the mtime"""
+    archive, member = split_archive_path(path)
+    if archive is not None:
+        info = open_archive(archive).getinfo(member)
+        return [info.file_size, info.CRC]
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def cached_parse_files(parser, files: list, cache: dict = None, workers: int = None) -> list:
+    """Like parse_files, but reuse the results in {cache} (path -> size, mtime, result) for files that are
+    unchanged, only parsing the rest (the seconds of a cached result are None).
+    The cache is updated, and compacted to hold just {files}"""
+    if cache is None:
+        return parse_files(parser, files, workers)
+
+    results = [None] * len(files)
+    fresh = {}
+    misses = []
+    for i, file in enumerate(files):
+        size, mtime = file_signature(file)
+        entry = cache.get(file)
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            # Hand out a copy - the caller (e.g. join_db) may add to the result
+            results[i] = (copy.deepcopy(entry['result']), None, None)
+            fresh[file] = entry
+        else:
+            misses.append((i, file, size, mtime))
+
+    parsed = parse_files(parser, [file for _, file, _, _ in misses], workers)
+    for (i, file, size, mtime), (result, error, seconds) in zip(misses, parsed):
+        results[i] = (result, error, seconds)
+        # Don't cache failures, they may be transient
+        if error is None and not (isinstance(result, dict) and 'error' in result):
+            fresh[file] = {'size': size, 'mtime': mtime, 'result': copy.deepcopy(result)}
+
+    # Only the files seen this time are kept, so deleted files are evicted
+    cache.clear()
+    cache.update(fresh)
+    print(f'{parser.__name__}: Parsed {len(misses)} of {len(files)} files ({len(files) - len(misses)} unchanged)')
+    return results
+
+
+def record_parse_stats(stats: dict, files: list, parsed: list):
+    """Add the file counts, bytes read and per-file parse times of {parsed} (from cached_parse_files) to {stats}"""
+    timings = {file: seconds for file, (_, _, seconds) in zip(files, parsed) if seconds is not None}
+    stats['files'] = len(files)
+    stats['parsed'] = len(timings)
+    stats['failed'] = sum(1 for _, error, _ in parsed if error is not None)
+    stats['bytes_read'] = sum(file_signature(file)[0] for file in timings)
+    stats['parse_seconds'] = timings
+
+
+def analyse_schema_file(schema_path: str):
+    """Extract the name, domain and description from an individual schema file (None if it is not a named schema)"""
+    filename = os.path.basename(schema_path)
+    schema_regex = re.match(r'(\w+)\.schema\.json$', filename)
+    if not schema_regex:
+#        print(f'No schema name found in [{filename}]')
+        return None
+
+    schema_name = schema_regex.group(1)
+    # Get the directory as a proxy to the schema 'domain'
+    domain_name = os.path.basename(os.path.dirname(schema_path))
+    detail = {'name': schema_name, 'domain': domain_name}
+
+    # Read the schema file to get the description
+    try:
+        with open_input(schema_path) as f:
+            schema = json.load(f)
+    except Exception as e:
+        # Still classify the schema by name and domain, even if it can't be read
+        detail['error'] = str(e)
+        return detail
+    if 'definitions' in schema:
+        definitions = schema['definitions']
+        detail['definitions'] = definition_names(definitions)
+        if schema_name in definitions:
+            item = definitions[schema_name]
+            if 'description' in item:
+                detail['description'] = item['description']
+#        else:
+#            print(f'Malformed Schema [{schema_name}] in [{domain_name}]: The name is not in the definitions section: [{definitions}]')
+    return detail
+
+
+def definition_names(definitions: dict) -> list:
+    """Return the names of all {definitions} in a schema, including those nested inside other definitions"""
+    names = []
+    for name, definition in definitions.items():
+        names.append(name)
+        if isinstance(definition, dict) and isinstance(definition.get('definitions'), dict):
+            names.extend(definition_names(definition['definitions']))
+    return names
+
+
+def classify_schema(root: str, files: list = None, workers: int = None, cache: dict = None, stats: dict = None,
+                    symbols: dict = None):
+    """Extract details (domain) from all schema files under {root} (or just {files}, from scan_repository).
+    Correlate with known API resources. Unchanged files are taken from {cache}, if given (see load_parse_cache).
+    File counts, bytes read and per-file parse times are added to {stats}, if given.
+    Every definition name is added to {symbols}, if given, with the list of schemas that define it (see link_index)"""
+    schema_files = find_files(root, SCHEMA) if files is None else files
+
+    start = time.perf_counter()
     schema_db = {}
 
-    for schema_path in schema_files:
-        filename = os.path.basename(schema_path)
-        schema_regex = re.match('(\w+)\.schema\.json$', filename)
-        if schema_regex:
-            schema_name = schema_regex.group(1)
-            # Get the directory as a proxy to the schema 'domain'
-            domain_name = os.path.basename(os.path.dirname(schema_path))
-            # Add this schema to the schema database
-            if schema_name not in schema_db:
-                node = f'{{"name": "{schema_name}", "domain": "{domain_name}" }}'
-                schema_db[schema_name] = json.loads(node)
-#           else:
-#               print(f'Schema [{schema_name}] in [{domain_name}] is already in the schema database from: [{schema_db[schema_name]["domain"]}]')
-            schema_entry = schema_db[schema_name]
-
-            # Read the schema file to get the description
-            try:
-                lines = open(schema_path, 'r').readlines()
-                schema = json.loads(''.join(lines))
-                if 'definitions' in schema:
-                    definitions = schema['definitions']
-                    if schema_name in definitions:
-                        item = definitions[schema_name]
-                        if 'description' in item:
-                            description = item['description']
-                            schema_entry['description'] = description
-#                    else:
-#                        print(f'Malformed Schema [{schema_name}] in [{domain_name}]: The name is not in the definitions section: [{definitions}]')
-            except Exception as e:
-                print(f'Unable to read schema file [{schema_path}]:\n * [{e}]')
+    parsed = cached_parse_files(analyse_schema_file, schema_files, cache, workers)
+    if stats is not None:
+        record_parse_stats(stats, schema_files, parsed)
+    # Parse in parallel, but merge in file order: the first file seen for a schema sets its domain
+    for schema_path, (detail, error, _) in zip(schema_files, parsed):
+        if detail is None:
+            continue
+        schema_name = detail['name']
+        # Add this schema to the schema database
+        if schema_name not in schema_db:
+            schema_db[schema_name] = {'name': schema_name, 'domain': detail['domain']}
+#       else:
+#           print(f'Schema [{schema_name}] in [{detail["domain"]}] is already in the schema database from: [{schema_db[schema_name]["domain"]}]')
+        schema_entry = schema_db[schema_name]
+
+        if 'error' in detail:
+            print(f'Unable to read schema file [{schema_path}]:\n * [{detail["error"]}]')
+            continue
+        if 'description' in detail:
+            schema_entry['description'] = detail['description']
+        if symbols is not None:
+            for definition in detail.get('definitions', ()):
+                schemas = symbols.setdefault(definition, [])
+                if schema_name in schemas:
+                    continue
+                # The schema named after a definition is its best home, ahead of any that nest a copy of it
+                if definition == schema_name:
+                    schemas.insert(0, schema_name)
+                else:
+                    schemas.append(schema_name)
+
+    print(f'classify_schema: Read {len(schema_files)} schema files in {time.perf_counter() - start:.1f}s')
+    return schema_db
+
+
+# Diagrams straight from the JSON schemas, for repositories (like v5) that don't ship the Resource PUML files
+SCHEMA_DIAGRAM_SKIP = re.compile('(Ref|RefOrValue|_FVO|_MVO|_Create|_Update)$')   # Schemas that don't get a diagram of their own
+SCHEMA_TYPES = {'string': 'String', 'integer': 'Integer', 'number': 'Number', 'boolean': 'Boolean', 'object': 'Object'}
+SCHEMA_FORMATS = {'date-time': 'DateTime', 'date': 'Date', 'uri': 'Uri'}
+
+def new_schema_graph() -> dict:
+    """Return an empty schema graph: the schema files loaded, and the classes resolved from them, so far.
+    Shared by all the diagrams, so that each file is loaded, and each class resolved, only once"""
+    return {'documents': {}, 'classes': {}, 'unreadable': []}
+
+
+def schema_name(schema_path: str) -> str:
+    """Return the name of the schema in file {schema_path} (Agreement for Agreement.schema.json), or None"""
+    match = re.match(r'(\w+)\.schema\.json$', os.path.basename(schema_path))
+    return match.group(1) if match else None
+
+
+def schema_document(graph: dict, schema_path: str):
+    """Return the parsed schema file {schema_path}, loading it into the {graph} the first time (None if unreadable)"""
+    documents = graph['documents']
+    if schema_path not in documents:
+        try:
+            with open_input(schema_path) as f:
+                documents[schema_path] = json.load(f)
+        except (OSError, ValueError, KeyError):
+            documents[schema_path] = None
+            graph['unreadable'].append(schema_path)
+    return documents[schema_path]
+
+
+def resolve_schema_ref(schema_path: str, ref: str) -> tuple:
+    """Return the (file, fragment) that the $ref {ref}, found in the schema file {schema_path}, points at"""
+    file, _, fragment = ref.partition('#')
+    file = os.path.normpath(os.path.join(os.path.dirname(schema_path), file)) if file else schema_path
+    return file, fragment
+
+
+def schema_class_name(schema_path: str, fragment: str) -> str:
+    """Return the class name for {fragment} of {schema_path}: the last part of a JSON pointer, a definition name,
+    or (for the whole file) the schema's name"""
+    if fragment.startswith('/'):
+        return fragment.rstrip('/').split('/')[-1].replace('~1', '/').replace('~0', '~')
+    return fragment or schema_name(schema_path) or os.path.basename(schema_path)
+
+
+def schema_definition(graph: dict, schema_path: str, fragment: str):
+    """Return the definition that {fragment} picks out of {schema_path}: a JSON pointer, a definition name, or
+    (if empty) the definition named after the file - or the whole file, if it has none (None if there isn't one)"""
+    node = schema_document(graph, schema_path)
+    if node is None:
+        return None
+    if fragment.startswith('/'):
+        for part in fragment.strip('/').split('/'):
+            node = node.get(part.replace('~1', '/').replace('~0', '~')) if isinstance(node, dict) else None
+        return node
+    definitions = node.get('definitions') or node.get('$defs') or {}
+    name = schema_class_name(schema_path, fragment)
+    if name in definitions:
+        return definitions[name]
+    return None if fragment else node
+
+
+def schema_type(spec: dict) -> str:
+    """Return the PlantUML attribute type for the (non-$ref) property {spec}"""
+    if spec.get('format') in SCHEMA_FORMATS:
+        return SCHEMA_FORMATS[spec['format']]
+    types = spec.get('type', 'object')
+    if isinstance(types, list):
+        types = next((t for t in types if t != 'null'), 'object')
+    return SCHEMA_TYPES.get(types, 'Object')
+
+
+def schema_class(graph: dict, schema_path: str, fragment: str = ''):
+    """Return the class (name, file, attributes and relations) of {fragment} of the schema file {schema_path}, resolved
+    once per {graph}. The properties of every allOf part - including any $ref'd parents - are flattened into the class.
+    Relations are to other classes by (file, fragment), which are only resolved when a diagram needs them"""
+    key = (schema_path, fragment)
+    classes = graph['classes']
+    if key in classes:
+        return classes[key]
+    # Resolving a class that (through allOf) includes itself finds None, rather than looping
+    classes[key] = None
+    definition = schema_definition(graph, schema_path, fragment)
+    if not isinstance(definition, dict):
+        return None
+
+    attributes = {}
+    relations = {}
+    for part in list(definition.get('allOf', [])) + [definition]:
+        if not isinstance(part, dict):
+            continue
+        if '$ref' in part:
+            parent = schema_class(graph, *resolve_schema_ref(schema_path, part['$ref']))
+            if parent is not None:
+                attributes.update(parent['attributes'])
+                relations.update(parent['relations'])
+        required = set(part.get('required', []))
+        for name, spec in (part.get('properties') or {}).items():
+            if not isinstance(spec, dict):
                 continue
+            array = spec.get('type') == 'array'
+            item = spec.get('items', {}) if array else spec
+            if isinstance(item, dict) and '$ref' in item:
+                target = resolve_schema_ref(schema_path, item['$ref'])
+                if array:
+                    multiplicity = '1..*' if spec.get('minItems', 0) > 0 else '0..*'
+                else:
+                    multiplicity = '1' if name in required else '0..1'
+                relations[name] = {'target': target, 'class': schema_class_name(*target), 'multiplicity': multiplicity}
+                attributes.pop(name, None)
+            else:
+                attributes[name] = schema_type(item if isinstance(item, dict) else {}) + ('[]' if array else '')
+                relations.pop(name, None)
+
+    model = {'name': schema_class_name(schema_path, fragment), 'file': schema_path, 'attributes': attributes, 'relations': relations}
+    classes[key] = model
+    return model
+
+
+def schema_puml(graph: dict, schema_path: str) -> str:
+    """Return a Resource PUML diagram of the schema in {schema_path} (or None if there is no schema in it), shaped like
+    the ones in the v4 repository: the schema is the <<Pivot>> class, "Ref" classes are <<Ref>>s, and the classes defined
+    in the same file are expanded in turn. Classes from other files are shown, but not expanded - they have their own diagrams"""
+    pivot = schema_class(graph, schema_path)
+    if pivot is None:
+        return None
+    lines = ['@startuml', 'hide circle', 'hide methods', 'hide stereotype', 'show <<Enumeration>> stereotype',
+             'skinparam class {', '   BackgroundColor<<Enumeration>> #E6F5F7', '   BackgroundColor<<Ref>> #FFFFE0',
+             '   BackgroundColor<<Pivot>> #FFFFFFF', '   BackgroundColor #FCF2E3', '}', '']
+    shown = {pivot['name']}
+    pending = [pivot]
+    while pending:
+        model = pending.pop(0)
+        if model is pivot:
+            lines.append(f'class {model["name"]}  {PIVOT} {{')
+        elif model['name'].endswith('RefOrValue'):
+            lines.append(f'class {model["name"]}  {{')
+        elif model['name'].endswith('Ref'):
+            lines.append(f'class {model["name"]}  {REF} {{')
         else:
-#            print(f'No schema name found in [{filename}]')
-            schema_name = None
-    return schema_db
+            lines.append(f'class {model["name"]}  {{')
+        lines += [f'    {name} : {type}' for name, type in model['attributes'].items()] + ['}', '']
+        if (model is not pivot and model['file'] != schema_path) or not model['relations']:
+            continue
+        for name, relation in model['relations'].items():
+            lines.append(f'{model["name"]} *-->  "{relation["multiplicity"]}" {relation["class"]} : {name}')
+            if relation['class'] not in shown:
+                shown.add(relation['class'])
+                target = schema_class(graph, *relation['target'])
+                # An unresolvable class is still drawn, empty
+                pending.append(target or {'name': relation['class'], 'file': None, 'attributes': {}, 'relations': {}})
+        lines.append('')
+    lines.append('@enduml')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_schema_pumls(schema_files: list, out_dir: str, stats: dict = None) -> list:
+    """Write a Resource_<Schema>.puml diagram (see schema_puml) into {out_dir} for each schema in {schema_files}
+    (but not the Ref, RefOrValue, FVO etc. variants), returning the list of diagrams - to use in place of the
+    Resource PUML files of the repository. Files are only rewritten if their content changed.
+    File counts are added to {stats}, if given"""
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    graph = new_schema_graph()
+    outputs = []
+    current = set()
+    rewritten = 0
+    for schema_path in schema_files:
+        name = schema_name(schema_path)
+        out_filename = os.path.join(out_dir, f'Resource_{name}.puml')
+        # The first schema file seen for a name is the one used, as in classify_schema
+        if name is None or SCHEMA_DIAGRAM_SKIP.search(name) or out_filename in current:
+            continue
+        puml = schema_puml(graph, schema_path)
+        if puml is None:
+            continue
+        outputs.append(out_filename)
+        current.add(out_filename)
+        try:
+            with open(out_filename, 'r') as f:
+                if f.read() == puml:
+                    continue
+        except OSError:
+            pass
+        with open(out_filename, 'w') as f:
+            f.write(puml)
+        rewritten += 1
+
+    # Diagrams of schemas that have gone
+    for stale in find_files(out_dir, PUML):
+        if stale not in current:
+            os.remove(stale)
+    print(f'generate_schema_pumls: Generated {len(outputs)} diagrams ({rewritten} changed) from {len(schema_files)} schema files '
+          f'in {time.perf_counter() - start:.1f}s, loading {len(graph["documents"])} files and resolving {len(graph["classes"])} classes')
+    if graph['unreadable']:
+        print(f'generate_schema_pumls: {len(graph["unreadable"])} referenced schema files could not be read, e.g. [{graph["unreadable"][0]}]')
+    if stats is not None:
+        stats.update(files=len(schema_files), diagrams=len(outputs), rewritten=rewritten, documents=len(graph['documents']),
+                     classes=len(graph['classes']), unreadable=len(graph['unreadable']))
+    return outputs
 
 
 def join_db(api_db, schema_db):
@@ -264,32 +1439,55 @@ def join_db(api_db, schema_db):
     return joined_db
 
 
-def classify_apis(root: str):
-    """Extract key details (API version, operations) about the main resources from all API rules files"""
-    RULES = '.*\.rules\.yaml$'
-
+def classify_apis(root: str, files: list = None, workers: int = None, cache: dict = None, stats: dict = None):
+    """Extract key details (API version, operations) about the main resources from all API rules files
+    under {root} (or just {files}, from scan_repository). Unchanged files are taken from {cache}, if given
+    (see load_parse_cache). File counts, bytes read and per-file parse times are added to {stats}, if given"""
     database = {}
-    rules_files = find_files(root, RULES)
+    rules_files = find_files(root, RULES) if files is None else files
     print(f'classify_apis: Found {len(rules_files)} files that fit [{RULES}]')
 
-    for file in rules_files:
-        try:
-            new_detail = analyse_rules_file(file)
-            database.update(new_detail)
-        except Exception as e:
+    start = time.perf_counter()
+    parsed = cached_parse_files(analyse_rules_file, rules_files, cache, workers)
+    if stats is not None:
+        record_parse_stats(stats, rules_files, parsed)
+    # Parse in parallel, but merge in file order so later rules files still win
+    for file, (new_detail, error, _) in zip(rules_files, parsed):
+        if error is not None:
             # Ignore this rules file and carry on
-            print(f'classify_apis: Unable to analyse rules file [{file}]:\n * [{e}]')
+            print(f'classify_apis: Unable to analyse rules file [{file}]:\n * [{error}]')
             continue
+        database.update(new_detail)
+    print(f'classify_apis: Read {len(rules_files)} rules files in {time.perf_counter() - start:.1f}s')
     return database
 
 
-def generate_api_files(out_dir: str, db: dict):
-    """Generate a PUML file (TMFxxx.puml) for each API in the API database"""
+def generate_api_files(out_dir: str, db: dict, manifest: dict = None, on_output=None, stats: dict = None,
+                       ids: list = None) -> list:
+    """Generate a PUML file (TMFxxx.puml) for each API in the API database (or just those with the TMF {ids}),
+    returning the list of output files.
+    With a {manifest}, only APIs whose database entries have changed are rewritten.
+    {on_output} is called with each output file as soon as it is up to date.
+    File counts and bytes written are added to {stats}, if given"""
     api_db = db['api']
     schema_db = db['schema']
 
-    for id in api_db:
+    outputs = []
+    rewritten = 0
+    bytes_written = 0
+    for id in api_db if ids is None else [id for id in ids if id in api_db]:
         api_detail = api_db[id]
+        out_filename = os.path.join(out_dir, f'TMF{id}.puml')
+        outputs.append(out_filename)
+        if manifest is not None:
+            # The API diagram is built from the API entry, and the descriptions and diagrams of its resources
+            resources = {resource: schema_db[resource].get('description') for resource in api_detail['resources'] if resource in schema_db}
+            links = {resource: link_target(resource, db) for resource in api_detail['resources']}
+            if not record_output(manifest, out_filename, fingerprint(api_detail, resources, links), apis=[id], schemas=sorted(resources)):
+                if on_output is not None:
+                    on_output(out_filename)
+                continue
+
         api_name = api_detail.get('name')
         api_version = api_detail.get('version')
         api_basePath = api_detail.get('basePath')
@@ -298,7 +1496,7 @@ def generate_api_files(out_dir: str, db: dict):
             # Wrap this description to 45 character width - to fit in the class diagram box
             # Strip certain redundant lines if present: Copyright, Release etc
             api_description = re.sub('Copyright.*\n', '', api_description)
-            api_description = re.sub('[\s#*]+\s\n', '', api_description)
+            api_description = re.sub(r'[\s#*]+\s\n', '', api_description)
             api_description = textwrap.fill(api_description, 80, break_long_words=False, replace_whitespace=True)
             api_description = api_description + ';\n'
         else:
@@ -323,7 +1521,11 @@ def generate_api_files(out_dir: str, db: dict):
             resource_detail = api_detail['resources'][resource]
             # Found resource [{resource}] in [{api_name}] with details: [{resource_detail}]
             # Write out a PUML class for each resource
-            puml += f'\n**[#99ff99]:<b>[[{resource}.svg {resource}]]'
+            target = link_target(resource, db)
+            if target is not None:
+                puml += f'\n**[#99ff99]:<b>[[{target}.svg {resource}]]'
+            else:
+                puml += f'\n**[#99ff99]:<b>{resource}'
             if resource in schema_db:
                 # Wrap this description to 80 character width - to make a wide resource box
                 description = schema_db[resource].get("description")
@@ -346,19 +1548,26 @@ def generate_api_files(out_dir: str, db: dict):
 
 
         # Write out a PUML file for the API overall (TMFxxx.puml)
-        out_filename = f'{out_dir}\\TMF{id}.puml'
         print(f'Writing API PUML file [{out_filename}]')
         api_puml = open(out_filename, 'w')
         api_puml.write(puml)
         api_puml.write('@endmindmap')
         api_puml.close()
+        rewritten += 1
+        if stats is not None:
+            bytes_written += file_size(out_filename)
+        if on_output is not None:
+            on_output(out_filename)
+    if stats is not None:
+        stats.update(files=len(outputs), rewritten=rewritten, bytes_written=bytes_written)
+    return outputs
 
 
 def analyse_rules_file(rules_path: str):
     """Extract key details (API version, operations) from an individual rules file"""
 
     # Pull out the TMF-ID and API name from the rules file name
-    match = re.search('TMF(\d+)_(\w+)', rules_path)
+    match = re.search(r'TMF(\d+)_(\w+)', rules_path)
     if match != None:
         id = match.group(1)
         name = match.group(2).replace('_', ' ')
@@ -368,7 +1577,8 @@ def analyse_rules_file(rules_path: str):
 
     try:
         # Load the Rules YAML file
-        yml = yaml.safe_load(open(rules_path, 'r'))
+        with open_input(rules_path) as f:
+            yml = yaml.load(f, Loader=YAML_LOADER)
     except Exception as e:
         raise Exception(f'Unable to read YAML file [{rules_path}]:\n * [{e}]')    
 
@@ -424,6 +1634,9 @@ def make_index(out_dir: str, db):
 
     index_file = open(f'{out_dir}\\index.htm', 'w')
     index_file.write('<html>\n<head>\n<link rel=\'stylesheet\' type=\'text/css\' href=\'domains.css\'>\n<title>TMF APIs</title>\n</head>\n<body>\n')
+    # Searches the index written by make_search_index
+    index_file.write('<div id="search"><input id="search-box" type="search" autocomplete="off" '
+                     'placeholder="Search schemas, resources, operations and notifications"><div id="search-results"></div></div>\n')
     for domain in DOMAINS:
         # Sort the schemas within each domain alphabetically by schema name
         domain_index[domain] = sorted(domain_index.get(domain, []), key=lambda x: x['name'])
@@ -438,6 +1651,302 @@ def make_index(out_dir: str, db):
                 index_file.write(f'  <div id="api-box"><div class="number">TMF{id}&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;v{version}</div><div class="title"><a href="TMF{id}.svg">{name}</a></div></div>\n')
             index_file.write(f'</div>\n')
     
+    index_file.write(f'<script>\nvar SEARCH_DOCS_PER_SHARD = {SEARCH_DOCS_PER_SHARD}, SEARCH_LIMIT = 50;{SEARCH_SCRIPT}</script>\n')
     index_file.write('</body>\n</html>')
     index_file.close()
-    return domain_index
\ No newline at end of file
+    return domain_index
+
+
+SEARCH_KINDS = ('api', 'resource', 'schema', 'definition', 'operation', 'notification')   # Search results are listed in this order
+SEARCH_DOCS_PER_SHARD = 1000    # Search results per docs-N.js file
+SEARCH_WORD = re.compile('[A-Z]+(?![a-z])|[A-Z]?[a-z]+[0-9]*|[0-9]+')    # ProductOfferingRef -> Product, Offering, Ref
+
+# Runs the search box in index.htm. The index files are scripts (JSONP) rather than JSON, so the search
+# works from file:// too - each calls tmfSearch.add() with its contents once it has loaded
+SEARCH_SCRIPT = '''
+var tmfSearch = (function () {
+  var loaded = {}, waiting = {}, latest = '';
+  function load(name, done) {
+    if (name in loaded) { done(loaded[name]); return; }
+    if (name in waiting) { waiting[name].push(done); return; }
+    waiting[name] = [done];
+    var script = document.createElement('script');
+    script.src = 'search/' + name + '.js';
+    script.onerror = function () { add(name, null); };
+    document.head.appendChild(script);
+  }
+  function add(name, data) {
+    loaded[name] = data;
+    var callbacks = waiting[name] || [];
+    delete waiting[name];
+    callbacks.forEach(function (done) { done(data); });
+  }
+  function loadAll(names, done) {
+    var results = {}, left = names.length;
+    if (!left) { done(results); return; }
+    names.forEach(function (name) {
+      load(name, function (data) { results[name] = data; if (--left === 0) done(results); });
+    });
+  }
+  function termShard(word) { return 'terms-' + (/[a-z0-9]/.test(word.charAt(0)) ? word.charAt(0) : '_'); }
+  function docShard(id) { return 'docs-' + Math.floor(id / SEARCH_DOCS_PER_SHARD); }
+  function search(query, done) {
+    var words = query.toLowerCase().split(/[^a-z0-9]+/).filter(Boolean);
+    if (!words.length) { done([]); return; }
+    loadAll(words.map(termShard), function (shards) {
+      // Every word must be the start of one of the terms of a result
+      var matches = null;
+      words.forEach(function (word) {
+        var terms = shards[termShard(word)] || {}, found = {};
+        for (var term in terms) {
+          if (term.lastIndexOf(word, 0) === 0) terms[term].forEach(function (id) { if (!matches || matches[id]) found[id] = true; });
+        }
+        matches = found;
+      });
+      // The documents are numbered in order of relevance
+      var ids = Object.keys(matches).map(Number).sort(function (a, b) { return a - b; }).slice(0, SEARCH_LIMIT);
+      var names = ids.map(docShard).filter(function (name, i, all) { return all.indexOf(name) === i; });
+      loadAll(names, function (docs) {
+        done(ids.map(function (id) { return (docs[docShard(id)] || [])[id % SEARCH_DOCS_PER_SHARD]; }).filter(Boolean));
+      });
+    });
+  }
+  function show(query, results) {
+    var list = document.getElementById('search-results');
+    list.innerHTML = '';
+    if (query && !results.length) { list.textContent = 'No matches'; return; }
+    results.forEach(function (doc) {
+      var item = document.createElement('div'), link = document.createElement('a'), kind = document.createElement('span');
+      link.href = doc[2];
+      link.textContent = doc[0];
+      kind.className = 'kind';
+      kind.textContent = ' ' + doc[1] + (doc[3] ? ' - ' + doc[3] : '');
+      item.appendChild(link);
+      item.appendChild(kind);
+      list.appendChild(item);
+    });
+  }
+  document.getElementById('search-box').addEventListener('input', function (event) {
+    var query = latest = event.target.value;
+    search(query, function (results) { if (query === latest) show(query, results); });
+  });
+  return { add: add, search: search };
+})();
+'''
+
+
+def search_words(*texts) -> set:
+    """Return the lower-case words in {texts} to index: each whole word, and its camelCase parts"""
+    words = set()
+    for text in texts:
+        for word in re.split('[^A-Za-z0-9]+', text or ''):
+            if word:
+                words.add(word.lower())
+                words.update(part.lower() for part in SEARCH_WORD.findall(word))
+    return words
+
+
+def search_documents(db) -> list:
+    """Return a [name, kind, href, context] for everything in {db} worth searching for, most relevant first:
+    the APIs, their resources, operations and notifications, and every schema and definition with a diagram"""
+    docs = []
+    for id, api_detail in db['api'].items():
+        api_title = f'TMF{id} {api_detail.get("name")}'
+        docs.append([api_title, 'api', f'TMF{id}.svg', f'v{api_detail.get("version")}'])
+        for resource, resource_detail in api_detail.get('resources', {}).items():
+            target = link_target(resource, db)
+            docs.append([resource, 'resource', f'{target}.svg' if target else f'TMF{id}.svg', api_title])
+            operations = resource_detail.get('operations') or []
+            if isinstance(operations, str):
+                operations = operations.split(',')
+            for operation in operations:
+                docs.append([f'{str(operation).strip()} {resource}', 'operation', f'TMF{id}.svg', api_title])
+            for notification in resource_detail.get('notifications') or []:
+                docs.append([str(notification), 'notification', f'TMF{id}.svg', f'{resource} in {api_title}'])
+    for name, schema_detail in db['schema'].items():
+        target = link_target(name, db)
+        if target is not None:
+            docs.append([name, 'schema', f'{target}.svg', schema_detail.get('domain')])
+    # The definitions that are only found inside another schema's diagram
+    for name, target in db.get('links', {}).items():
+        if name not in db['schema']:
+            docs.append([name, 'definition', f'{target}.svg', f'in {target}'])
+    docs.sort(key=lambda doc: (SEARCH_KINDS.index(doc[1]), doc[0].lower()))
+    return docs
+
+
+def make_search_index(out_dir: str, db, stats: dict = None) -> int:
+    """Write the search index for the search box in index.htm into {out_dir}/search, returning the number of
+    searchable documents. The words of each document are in terms-<first letter>.js, and the documents themselves
+    in docs-<N>.js, so the page only loads the parts of the index a search needs"""
+    search_dir = os.path.join(out_dir, 'search')
+    os.makedirs(search_dir, exist_ok=True)
+    for name in os.listdir(search_dir):
+        if re.match(r'(terms|docs)-\w+\.js$', name):
+            os.remove(os.path.join(search_dir, name))
+
+    docs = search_documents(db)
+    shards = {}
+    for id, (name, kind, href, context) in enumerate(docs):
+        for word in search_words(name, context):
+            shard = shards.setdefault(word[0] if word[0] in 'abcdefghijklmnopqrstuvwxyz0123456789' else '_', {})
+            shard.setdefault(word, []).append(id)
+
+    files = {f'terms-{shard}': terms for shard, terms in shards.items()}
+    for start in range(0, len(docs), SEARCH_DOCS_PER_SHARD):
+        files[f'docs-{start // SEARCH_DOCS_PER_SHARD}'] = docs[start:start + SEARCH_DOCS_PER_SHARD]
+    bytes_written = 0
+    for name, data in files.items():
+        script = f'tmfSearch.add({json.dumps(name)}, {json.dumps(data, separators=(",", ":"))});\n'
+        with open(os.path.join(search_dir, f'{name}.js'), 'w', encoding='utf-8') as f:
+            f.write(script)
+        bytes_written += len(script.encode('utf-8'))
+
+    terms = sum(len(terms) for terms in shards.values())
+    print(f'make_search_index: Indexed {len(docs)} documents by {terms} words, in {len(files)} files ({bytes_written:,} bytes)')
+    if stats is not None:
+        stats.update(documents=len(docs), terms=terms, files=len(files), bytes_written=bytes_written)
+    return len(docs)
+
+
+XLINK_HREF = re.compile(rb'xlink:href="([^"]*)"')
+EXTERNAL_LINK = re.compile(r'^([a-zA-Z][\w+.-]*:|#|//)')
+
+def svg_links(svg_path: str) -> list:
+    """Return every xlink:href in the SVG file {svg_path}, reading it a line at a time"""
+    links = []
+    with open(svg_path, 'rb') as f:
+        for line in f:
+            if b'xlink:href' in line:
+                links.extend(href.decode('utf-8', 'replace') for href in XLINK_HREF.findall(line))
+    return links
+
+
+def check_links(svg_dir: str, workers: int = None, stats: dict = None) -> dict:
+    """Check that every local xlink:href in the SVG files in {svg_dir} leads to a file that exists.
+    The SVGs are scanned in a pool of {workers} processes. Returns the unresolved links of each SVG with any;
+    the counts (and the unresolved links) are added to {stats}, if given"""
+    svg_files = find_files(svg_dir, r'.*\.svg$')
+    parsed = parse_files(svg_links, svg_files, workers)
+
+    checked = {}
+    broken = {}
+    links = 0
+    for svg_file, (hrefs, error, _) in zip(svg_files, parsed):
+        if error is not None:
+            print(f'check_links: Unable to read [{svg_file}]: {error}')
+            continue
+        for href in hrefs:
+            if HOST and href.startswith(HOST):
+                href = href[len(HOST):]
+            if EXTERNAL_LINK.match(href):
+                continue
+            links += 1
+            target = os.path.normpath(os.path.join(os.path.dirname(svg_file), href.split('#')[0].split('?')[0]))
+            if target not in checked:
+                checked[target] = os.path.exists(target)
+            if not checked[target] and href not in broken.get(svg_file, ()):
+                broken.setdefault(svg_file, []).append(href)
+
+    unresolved = sum(len(hrefs) for hrefs in broken.values())
+    print(f'check_links: {unresolved} unresolved links in {len(broken)} of {len(svg_files)} SVG files ({links} links checked)')
+    for svg_file in sorted(broken)[:20]:
+        print(f' * [{svg_file}]: {", ".join(broken[svg_file])}')
+    if len(broken) > 20:
+        print(f' * ... and {len(broken) - 20} more SVG files')
+    if stats is not None:
+        stats.update(files=len(svg_files), links=links, unresolved=unresolved, unresolved_links=broken)
+    return broken
+
+
+# SVG minification: only whitespace, comments and the trailing zeros of coordinates are dropped
+SVG_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+SVG_BETWEEN_TAGS = re.compile(r'>\s+<')
+SVG_GEOMETRY = re.compile(r'\b(x|y|x1|y1|x2|y2|cx|cy|rx|ry|r|width|height|points|d|textLength|font-size|stroke-width|viewBox|style)="([^"]*)"')
+SVG_TRAILING_ZEROS = re.compile(r'(\d)\.(\d*?)0+(?!\d)')
+
+def trim_number(match) -> str:
+    """12.5000 -> 12.5, 10.0000 -> 10"""
+    return f'{match.group(1)}.{match.group(2)}' if match.group(2) else match.group(1)
+
+
+def minify_svg(svg: str) -> str:
+    """Return {svg} without comments or whitespace between tags, and with trailing zeros trimmed from the numbers
+    in geometry attributes. Text, links and everything else are left exactly as they were"""
+    svg = SVG_COMMENT.sub('', svg)
+    svg = SVG_BETWEEN_TAGS.sub('><', svg)
+    return SVG_GEOMETRY.sub(lambda match: f'{match.group(1)}="{SVG_TRAILING_ZEROS.sub(trim_number, match.group(2))}"', svg)
+
+
+def compress_svg(svg_file: str) -> dict:
+    """Minify {svg_file} in place and write its precompressed .svg.gz (and .svg.br, with brotli) siblings.
+    Returns the sizes of the SVG before and after, and of each compressed sibling"""
+    with open(svg_file, 'r', encoding='utf-8') as f:
+        svg = f.read()
+    before = len(svg.encode('utf-8'))
+    minified = minify_svg(svg)
+    data = minified.encode('utf-8')
+    if minified != svg:
+        with open(svg_file, 'wb') as f:
+            f.write(data)
+    sizes = {'before': before, 'after': len(data)}
+    # No timestamp in the .gz, so identical SVGs give identical files
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    with open(svg_file + '.gz', 'wb') as f:
+        f.write(compressed)
+    sizes['gz'] = len(compressed)
+    if brotli is not None:
+        compressed = brotli.compress(data)
+        with open(svg_file + '.br', 'wb') as f:
+            f.write(compressed)
+        sizes['br'] = len(compressed)
+    return sizes
+
+
+def compress_svgs(svg_dir: str, workers: int = None, stats: dict = None) -> dict:
+    """Minify every SVG file in {svg_dir} and precompress it (see compress_svg), in a pool of {workers} processes.
+    SVGs whose .svg.gz is newer than they are have not changed, and are skipped.
+    Returns the total sizes; the file counts and sizes are added to {stats}, if given"""
+    svg_files = find_files(svg_dir, r'.*\.svg$')
+    changed = [svg_file for svg_file in svg_files
+               if not os.path.exists(svg_file + '.gz') or os.path.getmtime(svg_file + '.gz') < os.path.getmtime(svg_file)]
+    parsed = parse_files(compress_svg, changed, workers)
+
+    totals = {'before': 0, 'after': 0, 'gz': 0, 'br': 0}
+    failed = 0
+    for svg_file, (sizes, error, _) in zip(changed, parsed):
+        if error is not None:
+            print(f'compress_svgs: Unable to compress [{svg_file}]: {error}')
+            failed += 1
+            continue
+        for key, size in sizes.items():
+            totals[key] += size
+    saved = totals['before'] - totals['after']
+    print(f'compress_svgs: Minified {len(changed) - failed} of {len(svg_files)} SVG files ({len(svg_files) - len(changed)} unchanged), '
+          f'saving {saved:,} of {totals["before"]:,} bytes; {totals["gz"]:,} bytes gzipped'
+          + (f', {totals["br"]:,} bytes with Brotli' if brotli is not None else ' (install brotli for .svg.br files too)'))
+    if stats is not None:
+        stats.update(files=len(svg_files), compressed=len(changed) - failed, failed=failed, bytes_before=totals['before'],
+                     bytes_after=totals['after'], bytes_saved=saved, bytes_gz=totals['gz'], bytes_br=totals['br'])
+    return totals
+
+
+class NoCacheHandler(SimpleHTTPRequestHandler):
+    """Serve files with headers that stop the browser caching them, so a reload always shows the latest diagram"""
+    def end_headers(self):
+        self.send_header('Cache-Control', 'no-store, must-revalidate')
+        self.send_header('Expires', '0')
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        # Only the failures are worth printing
+        if len(args) > 1 and str(args[1]).startswith(('4', '5')):
+            super().log_message(format, *args)
+
+
+def serve_directory(directory: str, port: int = 8000) -> ThreadingHTTPServer:
+    """Serve {directory} at http://localhost:{port}/ from a background thread, returning the server"""
+    server = ThreadingHTTPServer(('localhost', port), partial(NoCacheHandler, directory=os.path.abspath(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'serve_directory: Serving [{directory}] at http://localhost:{port}/index.htm')
+    return server
@@ -1,29 +1,272 @@
 from os import write
 from crawler import find_files          # find_files matching a regexp from a root
+from crawler import scan_repository     # find all rules, schema and PUML files in one pass
 from crawler import modify_puml_files   # Adjust PUML files
 from crawler import classify_apis       # classify APIs in a PUML file
 from crawler import classify_schema     # classify schemas in a PUML file
-from crawler import generate_diagrams   # generate SVG files from PUML files
+from crawler import render_pipeline     # generate SVG files from PUML files as they are written
 from crawler import make_index          # generate an index.htm starter page
+from crawler import make_search_index   # generate the index searched from index.htm
 from crawler import join_db             # correlate schemas with APIs
+from crawler import link_index          # which diagram each schema definition appears in
+from crawler import generate_schema_pumls   # generate Resource PUML files from the JSON schemas
+from crawler import check_links         # find links in the SVG files that lead nowhere
+from crawler import compress_svgs       # minify the SVG files and precompress them for static hosting
 from crawler import write_json          # write a JSON to file
 from crawler import generate_api_files  # generate PUML files for APIs
+from crawler import load_manifest       # read the record of what was built last time
+from crawler import forget_fingerprints # make everything in the manifest look changed, for --full
+from crawler import load_parse_cache    # read the results of parsing unchanged files last time
+from crawler import load_render_costs   # read how long each diagram took to render last time
+from crawler import open_render_cache   # SVGs already rendered from the same PlantUML, by any build
+from crawler import close_render_cache  # report the render cache hit rate and trim it to size
+from crawler import needs_render        # has a PUML file changed since its SVG was rendered
+from crawler import mark_rendered       # record successfully rendered SVGs
+from crawler import remove_stale_outputs    # delete outputs that are no longer produced
+from crawler import report_renders      # summarise a render stage
+from crawler import new_build_report    # start a record of the timings of each stage
+from crawler import timed_stage         # time a stage of the build
+from crawler import record_traced_peak  # peak Python memory of the stages, and of the whole build
+from crawler import peak_rss            # peak memory use of the build
+from crawler import source_signatures   # sizes and mtimes of the source files, to spot changes
+from crawler import changed_sources     # which source files changed between two signatures
+from crawler import dependent_outputs   # which outputs are built from given sources, schemas or APIs
+from crawler import open_plantuml_pipe  # a warm PlantUML JVM for rendering one diagram at a time
+from crawler import pipe_render         # render a diagram through the warm PlantUML JVM
+from crawler import close_plantuml_pipe # stop the warm PlantUML JVM
+from crawler import serve_directory     # serve the website over HTTP
+from crawler import split_archive_path  # is the repository a ZIP file
+from crawler import RENDER_TIMEOUT, RENDER_CACHE_DIR, RENDER_CACHE_SIZE
 import json
+import argparse
+import time
+import cProfile
+import pstats
+import tracemalloc
 
-root = "../Open_API_And_Data_Model-4.0-Sprint-2020-03"
+def main():
+    parser = argparse.ArgumentParser(description='Generate a navigable website of TMF class diagrams')
+    parser.add_argument('root', nargs='?', default='../Open_API_And_Data_Model-4.0-Sprint-2020-03',
+                        help='Root directory of the TMF API repository')
+    parser.add_argument('--full', action='store_true',
+                        help='Ignore the build manifest and regenerate everything')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of files to parse, and PlantUML JVMs to run, at once (default: CPU count)')
+    parser.add_argument('--render-timeout', type=float, default=RENDER_TIMEOUT,
+                        help=f'Seconds a render may run beyond its estimated time (default: {RENDER_TIMEOUT})')
+    parser.add_argument('--render-cache', default=RENDER_CACHE_DIR,
+                        help=f'Directory of rendered SVGs shared between builds (default: {RENDER_CACHE_DIR})')
+    parser.add_argument('--render-cache-size', type=int, default=RENDER_CACHE_SIZE // 1024**2,
+                        help=f'Megabytes of SVG to keep in the render cache (default: {RENDER_CACHE_SIZE // 1024**2})')
+    parser.add_argument('--no-render-cache', action='store_true',
+                        help='Render every diagram, rather than reuse SVGs from the render cache')
+    parser.add_argument('--from-schemas', action='store_true',
+                        help="Generate the Resource diagrams from the JSON schemas, rather than use the repository's Resource_*.puml files (needed for v5)")
+    parser.add_argument('--compress', action='store_true',
+                        help='Minify the SVG files and write precompressed .svg.gz (and .svg.br, with brotli) copies alongside')
+    parser.add_argument('--report', default='build_report.json',
+                        help='JSON file to write the timings, file counts and memory use of each stage to (default: build_report.json)')
+    parser.add_argument('--watch', action='store_true',
+                        help='After the build, keep watching the repository and rebuild the diagrams affected by each change')
+    parser.add_argument('--serve', action='store_true',
+                        help='Serve the website at http://localhost:PORT/ (until interrupted)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to serve the website on (default: 8000)')
+    parser.add_argument('--poll', type=float, default=0.5,
+                        help='Seconds between checks of the repository for changes, with --watch (default: 0.5)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the build with cProfile (into build_profile.prof) - parse workers are not included')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='Record the peak Python memory of each stage in the report (slows the build down)')
+    args = parser.parse_args()
+    if args.watch and split_archive_path(args.root)[0] is not None:
+        parser.error('--watch needs an unpacked repository, not a ZIP file')
 
-api_db = classify_apis(root+ '/apis')
-write_json(f'api_db.json', api_db)
+    report = new_build_report(args.root)
+    if args.tracemalloc:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
 
-schema_db = classify_schema(root+ '/schemas')
-write_json(f'schema_db.json', schema_db)
+    start = time.perf_counter()
+    state = build(args, report)
+    report['seconds'] = time.perf_counter() - start
 
-joined_db = join_db(api_db, schema_db)
-#print(f'main: {json.dumps(schema_db, indent=2)}]')
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats('build_profile.prof')
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    if args.tracemalloc:
+        record_traced_peak(report)
+        tracemalloc.stop()
+    report['peak_rss_bytes'] = peak_rss()
+    write_json(args.report, report)
+    print(f'main: Build took {report["seconds"]:.1f}s - see [{args.report}] for the details')
 
-# print(f'api_details: [{json.dumps(schema_details, indent=2)}]')
-modify_puml_files(root+ '/apis', '..\\puml', joined_db)
-generate_api_files('..\\puml', joined_db)
+    if args.serve:
+        serve_directory('..\\svg', args.port)
+    try:
+        if args.watch:
+            watch(args, state)
+        elif args.serve:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        print('main: Stopped')
 
-generate_diagrams('..\\puml', '..\\svg')
-make_index('..\\svg', joined_db)
\ No newline at end of file
+
+def build(args, report: dict) -> dict:
+    """Build the website from the repository at {args.root}, timing each stage into {report}.
+    Returns what a later rebuild needs to know about this one (see watch)"""
+    root = args.root
+    MANIFEST = 'build_manifest.json'
+    manifest = load_manifest(MANIFEST)
+    if args.full:
+        forget_fingerprints(manifest)
+
+    with timed_stage(report, 'scan') as stage:
+        inventory = scan_repository(root, 'scan_cache.json')
+        stage.update({category: len(files) for category, files in inventory.items()})
+    PARSE_CACHE = 'parse_cache.json'
+    parse_cache = load_parse_cache(PARSE_CACHE)
+
+    with timed_stage(report, 'classify_apis') as stage:
+        api_db = classify_apis(root+ '/apis', inventory['rules'], args.workers, parse_cache['rules'], stage)
+    write_json(f'api_db.json', api_db)
+
+    with timed_stage(report, 'classify_schema') as stage:
+        symbols = {}
+        schema_db = classify_schema(root+ '/schemas', inventory['schemas'], args.workers, parse_cache['schemas'], stage, symbols)
+    write_json(f'schema_db.json', schema_db)
+    write_json(f'symbol_db.json', symbols)
+    if args.from_schemas:
+        with timed_stage(report, 'generate_schema_pumls') as stage:
+            inventory['puml'] = generate_schema_pumls(inventory['schemas'], '..\\schema_puml', stage)
+    write_json(PARSE_CACHE, parse_cache)
+
+    with timed_stage(report, 'join_db'):
+        joined_db = join_db(api_db, schema_db)
+        # Only link to diagrams that will exist
+        joined_db['links'] = link_index(symbols, inventory['puml'])
+    #print(f'main: {json.dumps(schema_db, indent=2)}]')
+
+    # print(f'api_details: [{json.dumps(schema_details, indent=2)}]')
+    outputs = []
+
+    def produce(submit):
+        # Render each PUML file as soon as it is written - but only if it changed (or lost its SVG) since the last build
+        def queue_render(file):
+            if needs_render(manifest, file, '..\\svg'):
+                submit(file)
+        # These run inside the generate_diagrams stage, alongside the rendering
+        with timed_stage(report, 'modify_puml_files') as stage:
+            outputs.extend(modify_puml_files(root+ '/apis', '..\\puml', joined_db, manifest, inventory['puml'], queue_render, stage))
+        with timed_stage(report, 'generate_api_files') as stage:
+            outputs.extend(generate_api_files('..\\puml', joined_db, manifest, queue_render, stage))
+
+    RENDER_COSTS = 'render_costs.json'
+    render_costs = load_render_costs(RENDER_COSTS)
+    render_cache = None if args.no_render_cache else open_render_cache(args.render_cache, args.render_cache_size * 1024**2)
+    with timed_stage(report, 'generate_diagrams') as stage:
+        results = render_pipeline('..\\svg', produce, workers=args.workers, timeout=args.render_timeout, costs=render_costs,
+                                  cache=render_cache, stats=stage)
+    write_json(RENDER_COSTS, render_costs)
+    if render_cache is not None:
+        close_render_cache(render_cache)
+    remove_stale_outputs(manifest, outputs, '..\\svg')
+    mark_rendered(manifest, results)
+    write_json(MANIFEST, manifest)
+
+    if args.compress:
+        with timed_stage(report, 'compress_svgs') as stage:
+            compress_svgs('..\\svg', args.workers, stage)
+
+    with timed_stage(report, 'make_index'):
+        make_index('..\\svg', joined_db)
+    with timed_stage(report, 'make_search_index') as stage:
+        make_search_index('..\\svg', joined_db, stage)
+
+    with timed_stage(report, 'check_links') as stage:
+        check_links('..\\svg', args.workers, stage)
+
+    return {'manifest': manifest, 'inventory': inventory, 'parse_cache': parse_cache, 'db': joined_db}
+
+
+def watch(args, state: dict):
+    """Poll the repository every {args.poll} seconds, rebuilding what depends on each file that changes (see rebuild)"""
+    # From the repository itself - with --from-schemas, the build's PUML files are the generated ones
+    signatures = source_signatures(scan_repository(args.root, 'scan_cache.json', quiet=True))
+    pipe = open_plantuml_pipe()
+    print(f'main: Watching [{args.root}] for changes - press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(args.poll)
+            inventory = scan_repository(args.root, 'scan_cache.json', quiet=True)
+            latest = source_signatures(inventory)
+            changed = changed_sources(signatures, latest)
+            if changed:
+                start = time.perf_counter()
+                rendered = rebuild(args, state, inventory, changed, pipe)
+                signatures = latest
+                print(f'main: {len(changed)} files changed - re-rendered {rendered} diagrams in {time.perf_counter() - start:.2f}s')
+    finally:
+        close_plantuml_pipe(pipe)
+
+
+def rebuild(args, state: dict, inventory: dict, changed: list, pipe: dict) -> int:
+    """Bring the website up to date with the {changed} source files, after the build that left {state}.
+    Only the diagrams that depend (by the build manifest) on a changed file, or on a schema or API that changed,
+    are rewritten, and they are rendered one at a time through the warm PlantUML {pipe}.
+    Returns the number of diagrams rendered"""
+    root = args.root
+    manifest = state['manifest']
+    old_db = state['db']
+    parse_cache = state['parse_cache']
+
+    # Only the changed rules and schema files are parsed again
+    api_db = classify_apis(root+ '/apis', inventory['rules'], 1, parse_cache['rules'])
+    symbols = {}
+    schema_db = classify_schema(root+ '/schemas', inventory['schemas'], 1, parse_cache['schemas'], None, symbols)
+    write_json('parse_cache.json', parse_cache)
+    if args.from_schemas:
+        # Any schema can appear in any number of diagrams - the unchanged diagrams are not rewritten
+        inventory['puml'] = generate_schema_pumls(inventory['schemas'], '..\\schema_puml')
+    db = join_db(api_db, schema_db)
+    db['links'] = link_index(symbols, inventory['puml'])
+
+    if args.from_schemas or db['links'] != old_db['links'] or inventory['puml'] != state['inventory']['puml']:
+        # Diagrams came or went, so any reference may now link somewhere else - let the manifest check every output.
+        # Likewise the diagrams generated from the schemas, which don't record which schema files they came from
+        sources, ids = inventory['puml'], None
+    else:
+        schemas = [name for name in db['schema'].keys() | old_db['schema'].keys() if db['schema'].get(name) != old_db['schema'].get(name)]
+        apis = [id for id in db['api'].keys() | old_db['api'].keys() if db['api'].get(id) != old_db['api'].get(id)]
+        outputs = dependent_outputs(manifest, changed, schemas, apis)
+        sources = [manifest['outputs'][out_file]['source'] for out_file in outputs if 'source' in manifest['outputs'][out_file]]
+        ids = [id for out_file in outputs if 'source' not in manifest['outputs'][out_file] for id in manifest['outputs'][out_file]['apis']]
+
+    to_render = []
+    def queue_render(file):
+        if needs_render(manifest, file, '..\\svg'):
+            to_render.append(file)
+    outputs = modify_puml_files(root+ '/apis', '..\\puml', db, manifest, sources, queue_render)
+    outputs += generate_api_files('..\\puml', db, manifest, queue_render, None, ids)
+    results = [pipe_render(pipe, file, '..\\svg', args.render_timeout) for file in to_render]
+    report_renders('rebuild', results, sum(result['seconds'] for result in results))
+    if ids is None:
+        remove_stale_outputs(manifest, outputs, '..\\svg')
+    mark_rendered(manifest, results)
+    write_json('build_manifest.json', manifest)
+
+    if args.compress:
+        compress_svgs('..\\svg', 1)
+    if db['api'] != old_db['api'] or db['schema'] != old_db['schema'] or db['links'] != old_db['links']:
+        make_index('..\\svg', db)
+        make_search_index('..\\svg', db)
+    state.update(db=db, inventory=inventory)
+    return len(results)
+
+
+# The parsers run in a process pool, which re-imports this module in each worker
+if __name__ == '__main__':
+    main()